@@ -5,11 +5,54 @@
 
 import os
 import sys
-import logging
-import datetime
+import time
 
-logger = None
+import fixtags_io
+
+class DefaultLogger:
+    '''Stands for `logging.getLogger(__name__)` until the logging is set up,
+    so that the script can be imported and used without setting it up, and
+    logging isn't imported until something is logged.'''
+
+    def __getattr__(self, name):
+        import logging
+        return getattr(logging.getLogger(__name__), name)
+
+# set up by setupLogging(), or by the gPodder extension that imports the
+# script to fix the episodes in its own process
+logger = DefaultLogger()
+episode_title = ''
 episode_fname = ''
+channel_title = ''
+episode_pubdate = 0
+
+# Keys of the episode info, the same as the environment variables set by
+# gPodder 2 for the post-download script.
+FILENAME = 'GPODDER_EPISODE_FILENAME'
+EPISODE_TITLE = 'GPODDER_EPISODE_TITLE'
+CHANNEL_TITLE = 'GPODDER_CHANNEL_TITLE'
+EPISODE_PUBDATE = 'GPODDER_EPISODE_PUBDATE'
+
+# the index of the episodes fixed by the scan mode
+SCAN_INDEX_FILENAME = os.path.expanduser('~/.fixtags_index.sqlite')
+# the files the scan mode fixes
+SCAN_EXTENSIONS = ('.mp3',)
+
+# If set, the episodes aren't written, and the results of the episodes that
+# would be fixed have the diff of the tags instead.
+PLAN = False
+# If set with PLAN, the batch and scan modes fix the episodes after planning
+# them, in the same process so that the tags are parsed once.
+APPLY = False
+# If set, a JSON line with the result of every episode is appended to this
+# file.
+METRICS_FILENAME = None
+# How many bytes of memory the parsed tags may take, so that the files that
+# haven't changed since they were planned aren't read again by APPLY; 0 turns
+# the cache off.
+TAG_CACHE_SIZE = 0
+# the TAG_CACHE_SIZE of APPLY unless it's given
+APPLY_TAG_CACHE_SIZE = 64 << 20
 
 
 class WrongInvocationError(Exception):
@@ -23,13 +66,14 @@ def setupLogging():
     Use the global `logger` object to log events in the app.
     '''
 
+    import logging
     global logger
     logger = logging.getLogger(sys.argv[0])
     logger.setLevel(logging.DEBUG)
 
-    # use file output
+    # use file output, the file is opened when the first message is logged
     LOG_FILENAME = os.path.join(os.path.dirname(sys.argv[0]), 'fixtags.log')
-    filelog = logging.FileHandler(LOG_FILENAME, 'a')
+    filelog = logging.FileHandler(LOG_FILENAME, 'a', delay=True)
     filelog.setLevel(logging.DEBUG)
 
     # use console
@@ -56,1141 +100,1169 @@ def trim_prefix(episode_title, prefix):
         if episode_title.startswith(prefix)
         else episode_title)
 
-def main():
-    # get episode info from the environment variables
-    global episode_title, episode_fname, channel_title, episode_pubdate
-    try:
-        episode_title = os.environ['GPODDER_EPISODE_TITLE']
-        episode_fname = os.environ['GPODDER_EPISODE_FILENAME']
-        channel_title = os.environ['GPODDER_CHANNEL_TITLE']
-        episode_pubdate = int(float(os.environ['GPODDER_EPISODE_PUBDATE']))
+# The fixes for the known podcasts are in the RULES_FILENAME JSON file, which
+# is a list of rules.
+#
+# Every rule lists the channel titles it applies to (or a 'prefix' or
+# a 'contains' string for the channels that change their titles), where the
+# ID3v2 tag comes from ('tag') and the operations on it ('ops'). The titles
+# are matched ignoring the case, the whitespace, the Unicode form and the
+# typographic quotes and dashes (see channel_key()); no two rules may have
+# the same channel title in this sense.
+#
+# 'tag' is one of:
+#   'new'         -- start with an empty ID3v2.4 tag;
+#   'read'        -- read the existing tag from the file;
+#   'read_or_new' -- read the existing tag, or start with an empty one if
+#                    there is no tag ('if_new' ops are applied in this case);
+#   'convert'     -- read the existing (usually v2.2) tag as 'old' and copy
+#                    the needed fields into a new ID3v2.4 tag;
+#   null          -- there is nothing to fix.
+#
+# The operations are applied in order:
+#   ['set', field, value]                -- set the field to a constant;
+#   ['copy', field, source]              -- copy the value from the source;
+#   ['trim', field, source, prefix]      -- copy without the prefix;
+#   ['slice', field, source, start, end] -- copy source[start:end];
+#   ['regex', source, pattern, fields, else] -- match the pattern on
+#       the source and set the fields from the templates, where '{1}' is
+#       the first group etc.; if there is no match, the 'else' ops are
+#       applied, or it's an error if it's null;
+#   ['delete', frames]                   -- delete the frames if present;
+#       the frames deleted from the read tag (e.g. the artwork) usually
+#       aren't even read from the file, see skipped_frames().
+#
+# A source is 'episode_title', 'channel_title', 'episode_year', or
+# 'tag.<field>'/'old.<field>' for a field of the current/old tag.
+#
+# 'delete_v1' removes the ID3v1 tag. 'only_if' is a [source, pattern] pair;
+# the episode is left alone if the pattern doesn't match the source.
+# 'comment' is for the humans.
+
+# the rules file next to the script
+RULES_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'fixtags_rules.json')
+# the compiled rules are cached here between the runs
+RULES_CACHE_FILENAME = RULES_FILENAME + '.cache'
+# changes when the compiled form of the rules or the way they are matched to
+# the channels changes; it's a part of the rules hashes, so that the episodes
+# are scanned again too
+RULES_CACHE_VERSION = 7
+
+# The typographic variants of the characters that the feeds swap when they
+# rename themselves, and the characters they stand for in the channel keys.
+CHANNEL_ALIASES = {
+    '\u2018': "'", '\u2019': "'", '\u201b': "'", '\u2032': "'",
+    '\u201c': '"', '\u201d': '"', '\u201f': '"', '\u2033': '"',
+    '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2013': '-',
+    '\u2014': '-', '\u2015': '-', '\u2212': '-',
+}
+CHANNEL_TRANSLATION = str.maketrans(CHANNEL_ALIASES)
+
+# the valid 'tag' values and the lengths of the operations
+TAG_SOURCES = ('new', 'read', 'read_or_new', 'convert', None)
+OP_LENGTHS = {'set': 3, 'copy': 3, 'trim': 4, 'slice': 5, 'regex': 5,
+        'delete': 2}
+# the frames (of all the ID3v2 versions) that the 'tag.<field>' sources are
+# read from
+TAG_FIELD_FRAMES = {
+    'title': ('TIT2', 'TT2'),
+    'artist': ('TPE1', 'TP1'),
+    'album_artist': ('TPE2', 'TP2'),
+    'album': ('TALB', 'TAL'),
+    'composer': ('TCOM', 'TCM'),
+    'genre': ('TCON', 'TCO'),
+    'track': ('TRCK', 'TRK'),
+    'date': ('TDRC', 'TYER', 'TDAT', 'TIME', 'TYE', 'TDA', 'TIM'),
+    'comment': ('COMM', 'COM'),
+    'picture': ('APIC', 'PIC'),
+}
+
+
+class RuleError(Exception):
+    '''This error is thrown when a rule is malformed or can't be applied to
+    the episode.'''
+    pass
 
-        import stagger
-    except KeyError:
-        print("""This script should be run by gPodder. Put its path and filename ({0}) as the argument to 'cmd_download_complete' option.
-For more information, go to 'http://wiki.gpodder.org/wiki/User_Manual#Time_stretching_.28making_playback_slower_or_faster.29', the 'Using the post-download script hook' section.""".format(os.path.abspath(sys.argv[0])), file=sys.stderr)
-        raise WrongInvocationError()
-    #print('Processing {0}'.format(episode_fname))
 
-    # calculate the publication year
-    episode_year = str(datetime.date.fromtimestamp(episode_pubdate).year)
+def channel_key(channel_title):
+    '''Returns the key of the channel title that doesn't change when a feed
+    changes the case, the whitespace or the Unicode form of its title, or
+    one of its CHANNEL_ALIASES characters.'''
+
+    import unicodedata
+    title = unicodedata.normalize('NFKC', channel_title)
+    title = title.translate(CHANNEL_TRANSLATION).casefold()
+    return ' '.join(title.split())
+
+def pattern_key(text):
+    '''Returns the `channel_key` of the prefix or substring of a rule that
+    keeps a space for the whitespace at its ends, so that the prefix
+    '60-Second ' doesn't match '60-Seconds'.'''
+
+    key = channel_key(text)
+    if text[:1].isspace():
+        key = ' ' + key
+    if text[-1:].isspace():
+        key += ' '
+    return key
+
+def build_rule_index(rules):
+    '''Returns the (index, patterns) pair for the rules, where the index
+    maps the `channel_key`s of the channel titles to the rules and the
+    patterns is the list of the ('prefix'/'contains', `pattern_key`, rule)
+    tuples to check otherwise. Raises RuleError if two rules have the same
+    key.'''
+
+    index = {}
+    patterns = []
+    for rule in rules:
+        for channel in rule.get('channels', []):
+            key = channel_key(channel)
+            if index.get(key, rule) is not rule:
+                raise RuleError("Channel '{0}' of '{1}' is also in '{2}'"
+                        .format(channel, rule_name(rule),
+                            rule_name(index[key])))
+            index[key] = rule
+        if 'prefix' in rule:
+            patterns.append(('prefix', pattern_key(rule['prefix']), rule))
+        if 'contains' in rule:
+            patterns.append(('contains', pattern_key(rule['contains']),
+                rule))
+    return (index, patterns)
+
+
+def rule_name(rule):
+    '''Returns the name of the rule: its first channel title, or its prefix
+    or substring.'''
+
+    if rule.get('channels'):
+        return rule['channels'][0]
+    return rule.get('prefix') or rule.get('contains')
+
+def ops_patterns(ops):
+    '''Yields the regex patterns of the operations, the 'else' ones too.'''
+
+    for op in ops:
+        if op[0] == 'regex':
+            yield op[2]
+            if op[4] is not None:
+                for pattern in ops_patterns(op[4]):
+                    yield pattern
+
+def build_regex_registry(rules):
+    '''Checks the regex patterns of the rules.
+
+    Returns the dictionary that maps the names of the rules to the
+    dictionaries of their patterns, where a pattern maps to the entry with
+    the 'regex' compiled on the first use (None until then) and the
+    'matches' and 'misses' counters.'''
+
+    import re
+    registry = {}
+    for rule in rules:
+        patterns = list(ops_patterns(rule.get('if_new', []) + rule['ops']))
+        if 'only_if' in rule:
+            patterns.append(rule['only_if'][1])
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise RuleError("Invalid pattern '{0}' of '{1}': {2}".format(
+                    pattern, rule_name(rule), e))
+        registry[rule_name(rule)] = dict((pattern,
+            {'regex': None, 'matches': 0, 'misses': 0})
+            for pattern in patterns)
+    return registry
+
+def check_ops(ops):
+    '''Raises RuleError if an operation is malformed.'''
+
+    for op in ops:
+        if not op or OP_LENGTHS.get(op[0]) != len(op):
+            raise RuleError("Invalid rule operation {0}".format(op))
+        if op[0] == 'regex' and op[4] is not None:
+            check_ops(op[4])
+
+def rule_hash(rule):
+    '''Returns the hash of the rule contents, which changes when the rule
+    or RULES_CACHE_VERSION does.'''
+
+    import hashlib
+    import json
+    return hashlib.sha1(json.dumps([RULES_CACHE_VERSION, rule],
+        sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def compile_rules(rules):
+    '''Checks the rules and compiles them into the dictionary with the
+    'rules' list, the 'index' and 'patterns' of `build_rule_index`, the
+    'regexes' registry and the 'rule_hashes' that map the rule names to
+    the hashes of the rules.'''
+
+    for rule in rules:
+        rule.pop('comment', None)
+        if rule.get('tag') not in TAG_SOURCES:
+            raise RuleError("Unknown tag source '{0}' of '{1}'".format(
+                rule.get('tag'), rule_name(rule)))
+        check_ops(rule.get('if_new', []) + rule['ops'])
+    (index, patterns) = build_rule_index(rules)
+    return {'rules': rules, 'index': index, 'patterns': patterns,
+            'regexes': build_regex_registry(rules),
+            'rule_hashes': dict((rule_name(rule), rule_hash(rule))
+                for rule in rules)}
+
+def rules_stamp(filename):
+    '''Returns the value that changes when the rules file changes.'''
+
+    stat = os.stat(filename)
+    return (RULES_CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+
+def load_rules(filename=RULES_FILENAME, cache_filename=RULES_CACHE_FILENAME):
+    '''Returns the compiled rules of the file, with its 'stamp' and the
+    'hash' of its contents and RULES_CACHE_VERSION.
+
+    The compiled rules are read from the cache if it's made from the same
+    version of the file. Otherwise the file is compiled and the cache is
+    updated, if it can be written. The cache is in the marshal format, which
+    is faster to load than pickle and needs no imports.'''
+
+    import marshal
+    stamp = rules_stamp(filename)
+    try:
+        with open(cache_filename, 'rb') as file:
+            compiled = marshal.load(file)
+        if compiled['stamp'] == stamp:
+            return compiled
+    except Exception:
+        # a missing or broken cache is just made again
+        pass
 
-    # the main set of checks
-    if channel_title == 'Escape from Cubicle Nation Podcast':
-        # set all v2 tags and remove v1
-        tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Pamela Slim'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write(episode_fname)
-
-    elif channel_title == 'EconTalk':
-        # set all v2 tags
-        tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Russ Roberts'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'The Naked Scientists':
-        # set all v2 tags
-        tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Chris Smith et al.'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'The Stack Exchange Podcast':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = trim_prefix(episode_title, 'Podcast ')
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Application Developer Days':
-        # set all v2 tags
-        tag2 = stagger.Tag24()
+    import hashlib
+    import json
+    with open(filename, 'rb') as file:
+        data = file.read()
+    compiled = compile_rules(json.loads(data.decode('utf-8')))
+    compiled['stamp'] = stamp
+    compiled['hash'] = hashlib.sha1('{0}\n'.format(
+        RULES_CACHE_VERSION).encode('ascii') + data).hexdigest()
+    temp_filename = '{0}.{1}'.format(cache_filename, os.getpid())
+    try:
+        with open(temp_filename, 'wb') as file:
+            marshal.dump(compiled, file)
+        os.replace(temp_filename, cache_filename)
+    except OSError:
+        pass
+    return compiled
+
+def use_rules(compiled):
+    '''Makes the compiled rules the current ones.'''
+
+    global RULES, RULE_INDEX, RULE_PATTERNS, REGEX_REGISTRY, RULES_STAMP, \
+            RULES_HASH, RULE_HASHES
+    RULES = compiled['rules']
+    RULE_INDEX = compiled['index']
+    RULE_PATTERNS = compiled['patterns']
+    REGEX_REGISTRY = compiled['regexes']
+    RULES_STAMP = compiled['stamp']
+    RULES_HASH = compiled['hash']
+    RULE_HASHES = compiled['rule_hashes']
+
+def reload_rules():
+    '''Loads the rules if they aren't loaded yet, or again if the rules file
+    has changed since they were loaded. Returns whether they were (re)loaded.
+    Raises ValueError or RuleError if the file is broken.'''
+
+    if rules_stamp(RULES_FILENAME) == RULES_STAMP:
+        return False
+    use_rules(load_rules())
+    return True
+
+# the rules are loaded when they are needed rather than on import, so that a
+# broken rules file is logged like the other errors
+use_rules({'rules': None, 'index': None, 'patterns': None, 'regexes': {},
+    'stamp': None, 'hash': None, 'rule_hashes': {}})
+
+def search_pattern(patterns, pattern, text):
+    '''Searches the pattern of the rule in the text and counts the match or
+    the miss. `patterns` is the rule's registry entry. The pattern is
+    compiled once, when it's used the first time.'''
+
+    entry = patterns[pattern]
+    if entry['regex'] is None:
         import re
-        parts = re.search(r'([^(]*) \((.*) на [^)]*\)', episode_title,
-                flags=re.IGNORECASE)
-        tag2.title = parts.group(1)
-        tag2.artist = parts.group(2)
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Fun English Lessons':
-        # set all v2 tags
-        tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'two Canadian brothers'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Learn English Funcast':
-        # set all v2 tags
-        tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Ron G'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == "radiogrinch's show":
-        # set all v2 tags
-        tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Radio Grinch'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Хекслет':
-        # set all v2 tags
-        tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'freetonik'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Все о США в подкастах':
-        # set all v2 tags and remove v1
-        tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Тимур Тажетдинов'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Science Friday':
-        # set all v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = 'Ira Flatow'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Поверх барьеров - Американский час - Радио Свобода':
-        # set all v2 tags and remove v1
-        tag2 = stagger.Tag24()
-        tag2.artist = 'Александр Генис'
-        tag2.title = episode_title[37:]
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.composer = 'RFE/RL Russian Service'
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Langsam gesprochene Nachrichten | Deutsch lernen | Deutsche Welle':
-        # set all v2 tags
-        tag2 = stagger.Tag24()
-        tag2.artist = 'Deutsche Welle'
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Америчка':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.write()
-
-    elif channel_title == 'Sick and Wrong':
-        # fix some v2 tags
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.artist = 'Dee and Harrison'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.title = trim_prefix(episode_title, 'Episode ')
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Sick and Wrong — Super Fucking Exclusive Feed':
-        # fix some v2 tags
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.artist = 'Dee and Harrison'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.title = trim_prefix(episode_title, 'S&W Episode ')
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Mysterious Universe':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = 'Benjamin Grundy, Aaron Wright'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'FLOSS Weekly':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Радио Бермудский Треугольник':
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.artist = 'Наташа, Оля, Даник'
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'This American Life':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = 'Ira Glass'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        try:
-            del tag2['PIC']
-        except KeyError:
-            pass
-        try:
-            del tag2['APIC']
-        except KeyError:
-            pass
-        tag2.write()
-
-    elif channel_title == 'Evergreen':
-        # fix some v2 tags
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-            tag2.artist = 'Artem Rosnovsky'
-        tag2.title = trim_prefix(episode_title, 'Episode ')
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.comment = ''
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'The Linux Admin Show':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.comment = ''
-        tag2.write()
-
-    elif channel_title == 'Подкаст на трезвую голову':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.write()
-
-    elif channel_title == 'Freakonomics Radio':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.composer = tag2.artist
-        tag2.artist = 'Steven D. Levitt, Stephen J. Dubner'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        try:
-            del tag2['COMM']
-        except KeyError:
-            pass
-        try:
-            del tag2['APIC']
-        except KeyError:
-            pass
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'Янки после пьянки':
-        # fix some v2 tags and remove v1
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Янки после пьянки'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Stuff Mom Never Told You':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = 'Cristen and Caroline'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'BrainStuff':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = 'Marshall Brain'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'Stuff To Blow Your Mind':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = 'Robert and Julie'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'Stuff You Should Know':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = 'Josh Clark and Chuck Bryant'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'Machine of Death':
-        # move v2.2 to v2.4 tags
-        tag22 = stagger.read_tag(episode_fname)
-        tag2 = stagger.Tag24()
-        tag2.artist = tag22.artist
-        tag2.album = channel_title
-        tag2.title = tag22.title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title.startswith('English as a Second Language'):
-        # move v2.2 to v2.4 tags
-        tag22 = stagger.read_tag(episode_fname)
+        entry['regex'] = re.compile(pattern)
+    parts = entry['regex'].search(text)
+    if parts:
+        entry['matches'] += 1
+    else:
+        entry['misses'] += 1
+    return parts
+
+def log_regex_stats():
+    '''Logs the match and miss counters of the patterns used by this
+    process.'''
+
+    for (name, patterns) in sorted(REGEX_REGISTRY.items()):
+        for (pattern, entry) in patterns.items():
+            if entry['matches'] or entry['misses']:
+                logger.debug("'{0}' pattern '{1}': {2} matches, "
+                        "{3} misses".format(name, pattern, entry['matches'],
+                            entry['misses']))
+
+def find_rule(channel_title):
+    '''Returns the rule for the channel or None if there is no rule. The
+    titles are compared by their `channel_key`s; a 'contains' rule matches
+    only the titles that don't start with its substring.'''
+
+    if RULE_INDEX is None:
+        reload_rules()
+    key = channel_key(channel_title)
+    rule = RULE_INDEX.get(key)
+    if rule is not None:
+        return rule
+    for (kind, text, rule) in RULE_PATTERNS:
+        if ((kind == 'prefix' and key.startswith(text)) or
+                (kind == 'contains' and key.find(text) > 0)):
+            return rule
+    return None
+
+def rule_value(source, values, tag2, old_tag):
+    '''Returns the value of the source for a rule operation.'''
+
+    if source.startswith('tag.'):
+        return getattr(tag2, source[4:])
+    if source.startswith('old.'):
+        return getattr(old_tag, source[4:])
+    return values[source]
+
+def apply_ops(ops, values, tag2, old_tag, patterns):
+    '''Applies the rule operations to the tag. `patterns` is the rule's
+    entry of the regex registry.'''
+
+    for op in ops:
+        kind = op[0]
+        if kind == 'set':
+            setattr(tag2, op[1], op[2])
+        elif kind == 'copy':
+            setattr(tag2, op[1], rule_value(op[2], values, tag2, old_tag))
+        elif kind == 'trim':
+            setattr(tag2, op[1],
+                    trim_prefix(rule_value(op[2], values, tag2, old_tag), op[3]))
+        elif kind == 'slice':
+            setattr(tag2, op[1],
+                    rule_value(op[2], values, tag2, old_tag)[op[3]:op[4]])
+        elif kind == 'regex':
+            (source, pattern, fields, otherwise) = op[1:]
+            parts = search_pattern(patterns, pattern,
+                    rule_value(source, values, tag2, old_tag))
+            if parts:
+                groups = (parts.group(0),) + parts.groups()
+                for (field, template) in fields.items():
+                    setattr(tag2, field, template.format(*groups))
+            elif otherwise is None:
+                raise RuleError("'{0}' doesn't match '{1}'".format(
+                    pattern, values[source]))
+            else:
+                apply_ops(otherwise, values, tag2, old_tag, patterns)
+        elif kind == 'delete':
+            for frame in op[1]:
+                try:
+                    del tag2[frame]
+                except KeyError:
+                    pass
+        else:
+            raise RuleError("Unknown rule operation '{0}'".format(kind))
+
+def ops_sources(ops):
+    '''Yields the sources of the operations, the 'else' ones too.'''
+
+    for op in ops:
+        if op[0] in ('copy', 'trim', 'slice'):
+            yield op[2]
+        elif op[0] == 'regex':
+            yield op[1]
+            if op[4] is not None:
+                for source in ops_sources(op[4]):
+                    yield source
+
+def skipped_frames(rule):
+    '''Returns the ids of the frames that the rule deletes from the tag it
+    reads, so that they needn't be read at all: the frames of the top-level
+    'delete' operations that no 'tag.<field>' source before them is read
+    from (see TAG_FIELD_FRAMES). The old tag of a 'new' rule is only
+    compared with the new one, which has no artwork, so its artwork frames
+    are skipped.'''
+
+    if rule['tag'] == 'new':
+        return list(TAG_FIELD_FRAMES['picture'])
+    frames = []
+    if rule['tag'] not in ('read', 'read_or_new'):
+        return frames
+    read = set()
+    for op in rule['ops']:
+        if op[0] == 'delete':
+            frames.extend(frame for frame in op[1] if frame not in read)
+            continue
+        for source in ops_sources([op]):
+            if source.startswith('tag.'):
+                if source[4:] not in TAG_FIELD_FRAMES:
+                    # who knows where it's read from
+                    return frames
+                read.update(TAG_FIELD_FRAMES[source[4:]])
+    return frames
+
+# The parsed tags of the files by their (device, inode), the least recently
+# used first. An entry is the ((size, mtime_ns), skipped frame ids) it's
+# valid for, the `parsed_size` of the tag and the tuple returned by
+# read_tag().
+tag_cache = None
+tag_cache_bytes = 0
+
+def parsed_size(tag, snapshot):
+    '''Returns the estimate of the memory taken by the parsed tag and its
+    snapshot, in bytes: the frame objects and all the values they hold.'''
+
+    seen = set()
+    values = [tag, snapshot]
+    if tag is not None:
+        for frame in tag.frames():
+            values.append(frame)
+            values.append(vars(frame))
+    size = 0
+    while values:
+        value = values.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+        if isinstance(value, (tuple, list)):
+            values.extend(value)
+        elif isinstance(value, dict):
+            values.extend(value.keys())
+            values.extend(value.values())
+    return size
+
+def read_tag(filename, skip_frames):
+    '''Reads and decodes the ID3v2 tag of the file like
+    `fixtags_io.read_tag_data()`, or takes it from the tag cache if the
+    file hasn't changed since.
+
+    Returns the tuple of the tag (None if there is no valid one), the stagger
+    error it couldn't be decoded with (or None), its `frames_snapshot` with
+    the skipped frames, whether there is an ID3v1 tag, the bytes read and the
+    file size. The tag is shared with the cache, so it must be copied before
+    it's changed.'''
+
+    global tag_cache, tag_cache_bytes
+    import stagger
+    stat = os.stat(filename)
+    key = (stat.st_dev, stat.st_ino)
+    valid = ((stat.st_size, stat.st_mtime_ns), tuple(skip_frames))
+    if tag_cache is not None and key in tag_cache:
+        entry = tag_cache[key]
+        if entry[0] == valid:
+            tag_cache.move_to_end(key)
+            return entry[2][:4] + (0,) + entry[2][5:]
+        del tag_cache[key]
+        tag_cache_bytes -= entry[1]
+
+    (data, v1, bytes_read, file_size, skipped) = \
+            fixtags_io.read_tag_data(filename, skip_frames)
+    tag = None
+    error = None
+    try:
+        tag = stagger.decode_tag(data)
+    except stagger.errors.Error as e:
+        error = e
+    parsed = (tag, error, fixtags_io.frames_snapshot(tag, skipped), v1,
+            bytes_read, file_size)
+
+    size = parsed_size(tag, parsed[2]) if TAG_CACHE_SIZE > 0 else 0
+    if 0 < size <= TAG_CACHE_SIZE:
+        if tag_cache is None:
+            import collections
+            tag_cache = collections.OrderedDict()
+        tag_cache[key] = (valid, size, parsed)
+        tag_cache_bytes += size
+        while tag_cache_bytes > TAG_CACHE_SIZE:
+            (old_key, entry) = tag_cache.popitem(last=False)
+            tag_cache_bytes -= entry[1]
+    return parsed
+
+def forget_tag(filename):
+    '''Removes the tag of the file from the tag cache; called before the
+    file is written.'''
+
+    global tag_cache_bytes
+    if tag_cache:
+        stat = os.stat(filename)
+        entry = tag_cache.pop((stat.st_dev, stat.st_ino), None)
+        if entry is not None:
+            tag_cache_bytes -= entry[1]
+
+def new_result(outcome):
+    '''Returns the result dictionary of an episode with the outcome, the
+    'rule' name, 'bytes_read', 'bytes_written', 'file_size' (None if the
+    file isn't read), whether the ID3v1 tag is deleted ('delete_v1'), the
+    'copy_method' of the audio data if it's moved (see
+    `fixtags_io.COPY_METHODS`), the 'read_seconds' and 'write_seconds'
+    spent on the tags, and the `fixtags_io.TagSummary` of the resulting
+    'tag' (None if the file isn't read).'''
+
+    return {'outcome': outcome, 'rule': None, 'bytes_read': 0,
+            'bytes_written': 0, 'file_size': None, 'delete_v1': False,
+            'copy_method': None, 'read_seconds': 0.0, 'write_seconds': 0.0,
+            'tag': None}
+
+def apply_rule(rule, episode_fname, values):
+    '''Fixes the tags of the episode file according to the rule.
+
+    The `values` dictionary has the 'episode_title', 'channel_title' and
+    'episode_year' sources for the operations. Only the tags are read from
+    the file, and it isn't written if the tags are already right. Returns the
+    result dictionary of `new_result` with the 'outcome' ('fixed',
+    'unchanged', 'nothing to fix' or 'skipped').
+
+    With PLAN, the outcome is 'would fix' instead of 'fixed', and the 'diff'
+    of `fixtags_io.frames_diff` and 'delete_v1' keys tell what would be
+    written.'''
+
+    result = new_result('nothing to fix')
+    if rule['tag'] is None:
+        return result
+    patterns = REGEX_REGISTRY[rule_name(rule)]
+    if 'only_if' in rule:
+        (source, pattern) = rule['only_if']
+        if not search_pattern(patterns, pattern, values[source]):
+            result['outcome'] = 'skipped'
+            return result
+
+    import copy
+    import stagger
+
+    start = time.perf_counter()
+    # the snapshot of the existing tag tells whether the rule changes anything
+    (existing, error, before, v1, result['bytes_read'],
+            result['file_size']) = read_tag(episode_fname,
+                    skipped_frames(rule))
+
+    old_tag = None
+    if rule['tag'] == 'new':
         tag2 = stagger.Tag24()
-        tag2.artist = tag22.artist
-        tag2.album = channel_title
-        tag2.title = tag22.title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.comment = tag22.comment
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Wide Teams':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.write()
-
-    elif channel_title == 'Radiolab':
-        # fix some v2 tags
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
+        ops = rule['ops']
+    elif rule['tag'] == 'read':
+        if error is not None:
+            raise error.with_traceback(None)
+        tag2 = copy.deepcopy(existing)
+        ops = rule['ops']
+    elif rule['tag'] == 'read_or_new':
+        if isinstance(error, stagger.errors.NoTagError):
             tag2 = stagger.Tag24()
-            tag2.artist = channel_title
-            tag2.title = episode_title
-            tag2.date = episode_year
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'happy friday podcast from gAmUssA ;-)':
-        # fix some v2 tags
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.artist = 'gAmUssA'
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Material World':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title.find('Quick and Dirty Tips') > 0:
-        # move v2.2 to v2.4 tags
-        tag22 = stagger.read_tag(episode_fname)
-        tag2 = stagger.Tag24()
-        tag2.artist = tag22.artist
-        tag2.album = tag22.album
-        tag2.title = tag22.title
-        tag2.genre = 'Podcast'
-        tag2.date = tag22.date
-        tag2.track = tag22.track
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Ask the Naked Scientists':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title[39:]
-        tag2.artist = 'Chris Smith'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Listen to English':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'All In The Mind':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.write()
-
-    elif channel_title == 'Accidental Tech Podcast':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        try:
-            del tag2['CTOC']
-        except KeyError:
-            pass
-        try:
-            del tag2['CHAP']
-        except KeyError:
-            pass
-        tag2.write()
-
-    elif channel_title == 'NPR: Car Talk Podcast':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title[9:]
-        tag2.artist = 'Click and Clack, the Tappet Brothers'
-        tag2.album = 'Car Talk'
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title.startswith('60-Second '):
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2['COM'] = []
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'NPR: Intelligence Squared Podcast':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = 'Intelligence Squared'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'Подкаст из Силиконовой Долины':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = 'Alex'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif ((channel_title == 'сегодня четверг - dugwin') or
-            (channel_title == 'dugwin j. goines // podcast')):
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = 'dugwin'
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'NPR: Planet Money':
-        # fix some v2 tags and remove v1
+            ops = rule.get('if_new', []) + rule['ops']
+        elif error is not None:
+            raise error.with_traceback(None)
+        else:
+            tag2 = copy.deepcopy(existing)
+            ops = rule['ops']
+    elif rule['tag'] == 'convert':
+        if error is not None:
+            raise error.with_traceback(None)
+        old_tag = existing
         tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Robert Smith'
-        tag2.album = 'Planet Money'
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Разбор Полетов':
-        # fix some v2 tags and remove v1
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.date = episode_year
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        try:
-            del tag2['CTOC']
-        except KeyError:
-            pass
-        try:
-            del tag2['CHAP']
-        except KeyError:
-            pass
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write(episode_fname)
-
-    elif channel_title == 'The Adam Carolla Show':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Chiptune - 8-bit game music podcast':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = 'Дмитрий Зомбак'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        del tag2['COMM']
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'Software Engineering Radio':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.title = trim_prefix(episode_title, 'SE-Radio Episode ')
-        tag2.write()
-
-    elif channel_title == 'Ирландское рагу by Emaster':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = 'Emaster'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Эхо Москвы. Точка':
-        # fix some v2 tags
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Александр Плющев'
-        tag2.composer = 'Эхо Москвы'
-        tag2.album = 'Точка'
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Радио-Т' or channel_title == 'Пираты-РТ':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.date = episode_year
-        tag2.write()
-
-    elif channel_title == 'The Dave Ramsey Show':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.write()
-
-    elif channel_title == 'Common Sense with Dan Carlin':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.album = 'Common Sense'
-        tag2.write()
-
-    elif channel_title == 'EnglishLingQ':
-        # fix some v2 tags
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        import re
-        parts = re.search(r'^\#(\d{1,3}) (?:[-–] )?([^-–]+) [-–] (.+)$',
-                episode_title, flags=re.IGNORECASE)
-        tag2.title = parts.group(3) if parts else episode_title
-        tag2.artist = parts.group(2) if parts else 'Steve and Alex'
-        #tag2.track = parts.group(1)
-        tag2.genre = 'Podcast'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'TuxRadar Linux Podcast':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'PODъезд. Записки со всего света':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.write()
-
-    elif channel_title == 'Плёнки':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'A Way with Words':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'www.it4business.ru':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = 'Слава Панкратов'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.write()
-
-    elif channel_title == 'Fonarev':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'happypm':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title[:-15]
-        tag2.artist = 'Слава Панкратов, Саша Орлов'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'No Agenda':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'scene':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Казах в Канаде':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.title = episode_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Nunavut':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title[20:]
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Sex Nerd Sandra':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Dolce Welle - подкаст из Европы':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = 'Alex'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'No BS IT':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = 'Budam'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'The Changelog':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.date = episode_year
-        tag2.write()
-
-    elif channel_title == 'Dr.Shadow из Британии':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.title = episode_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'The Haskell Cast':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'The raywenderlich.com Podcast':
-        # fix some v2 tags
-        import re
-        parts = re.search(r'^(.*) – Podcast (.+) (.+)$', episode_title,
-                flags=re.IGNORECASE)
+        ops = rule['ops']
+    else:
+        raise RuleError("Unknown tag source '{0}'".format(rule['tag']))
+    result['read_seconds'] = time.perf_counter() - start
+
+    apply_ops(ops, values, tag2, old_tag, patterns)
+    after = fixtags_io.frames_snapshot(tag2)
+
+    delete_v1 = result['delete_v1'] = bool(rule.get('delete_v1', False) and
+            v1)
+    result['tag'] = fixtags_io.TagSummary(tag2, v1 and not delete_v1)
+    if before == after and not delete_v1:
+        result['outcome'] = 'unchanged'
+        return result
+    if PLAN:
+        result['outcome'] = 'would fix'
+        result['diff'] = fixtags_io.frames_diff(before, after)
+        return result
+
+    start = time.perf_counter()
+    forget_tag(episode_fname)
+    (result['bytes_written'], result['copy_method']) = fixtags_io.write_tags(
+            episode_fname, tag2, delete_v1)
+    result['write_seconds'] = time.perf_counter() - start
+    result['outcome'] = 'fixed'
+    return result
+
+def fix_episode(filename, episode_title, channel_title, pubdate):
+    '''Fixes the tags of one downloaded episode.
+
+    Returns the result dictionary of `new_result` with the 'outcome'
+    ('fixed', 'unchanged', 'nothing to fix', 'skipped' or 'no rule') and
+    the total 'seconds'.
+    '''
 
-        tag2 = stagger.read_tag(episode_fname)
-        if parts:
-            tag2.title = "{0}{1}: {2}".format(parts.group(2), parts.group(3),
-                    parts.group(1))
-        else:
-            tag2.title = episode_title
-        tag2.artist = channel_title
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Russian-Canadian Moose Podcast - pirate raw records!':
-        # fix some v2 tags
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.artist = 'Канадский Лось и Co.'
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif channel_title == 'IT мысли':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Developing Perspective':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Russian Canadian Moose PodCast':
-        # fix some v2 tags
-        import re
-        parts = re.search(r'^(\d{1,4})-.* - (.*)$', episode_title,
-                flags=re.IGNORECASE)
-
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        if parts:
-            track = parts.group(1)
-            tag2.track = track
-            tag2.title = "{0}: {1}".format(track, parts.group(2))
-        tag2.write()
-
-    elif channel_title == 'Under the Radar':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Бананы и линзы':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = channel_title
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Подкаст "На чемоданах"':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = 'degiz'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Magic Read Along':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.write()
-
-    elif channel_title == 'Coffee Break German':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == "JavaPubHouse Off-Heap's podcast":
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = trim_prefix(episode_title, 'Episode ')
-        tag2.artist = 'Freddy Guime, et al.'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Hanselminutes':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = trim_prefix(tag2.title, channel_title + ' ')
-        tag2.write()
-
-    elif channel_title == 'Why Are Computers':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.write()
-
-    elif channel_title == 'Emaster':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = channel_title
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'LambdaCast':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Programming Throwdown':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = trim_prefix(tag2.title, 'Episode ')
-        tag2.write()
-
-    elif channel_title == 'DevZen Podcast':
-        # fix some v2 tags
-        import re
-        parts = re.search(r'^(.*) — Episode (\d+)$', episode_title,
-                flags=re.IGNORECASE)
-
-        if parts:
-            tag2 = stagger.read_tag(episode_fname)
-            tag2.title = "{0}: {1}".format(parts.group(2), parts.group(1))
-            tag2.write()
-
-    elif channel_title == 'Functional Geekery':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = trim_prefix(episode_title, 'Functional Geekery Episode ')
-        tag2.write()
-
-    elif channel_title == 'Command Line Heroes':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Noise Security Bit':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.title = trim_prefix(episode_title, 'Noise Security Bit ')
-        tag2.write()
-
-    elif channel_title == 'Soft Skills Engineering':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = 'Dave Smith and Jamison Dance'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Stacktrace':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        try:
-            del tag2['CTOC']
-        except KeyError:
-            pass
-        try:
-            del tag2['CHAP']
-        except KeyError:
-            pass
-        tag2.write()
-
-    elif channel_title == '99% Invisible':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Criminal':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.write()
-
-    elif channel_title == 'The Amp Hour Electronics Podcast':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.artist = channel_title
-        tag2.write()
-
-    elif channel_title == 'Inside iOS Dev':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'This is Love':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = trim_prefix(episode_title, 'Episode ')
-        tag2.album = channel_title
-        try:
-            del tag2['APIC']
-        except KeyError:
-            pass
-        tag2.write()
-
-    elif channel_title == 'You Are Not So Smart':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'The Art Of Programming':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'This Week in Linux':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        try:
-            del tag2['CHAP']
-        except KeyError:
-            pass
-        tag2.write()
+    start = time.perf_counter()
+    rule = find_rule(channel_title)
+    if rule is None:
+        logger.info("No fixes for the episode. GPODDER_CHANNEL_TITLE='{0}' "
+                "GPODDER_EPISODE_TITLE='{1}' GPODDER_EPISODE_FILENAME='{2}' "
+                "GPODDER_EPISODE_PUBDATE='{3}'".format(channel_title,
+                    episode_title, filename, pubdate))
+        result = new_result('no rule')
+    else:
+        import datetime
+        # calculate the publication year
+        episode_year = str(datetime.date.fromtimestamp(pubdate).year)
+
+        result = apply_rule(rule, filename, {
+            'episode_title': episode_title,
+            'channel_title': channel_title,
+            'episode_year': episode_year,
+        })
+        result['rule'] = rule_name(rule)
+    result['seconds'] = time.perf_counter() - start
+
+    logger.debug("{0}: {1}, {2} bytes read, {3} bytes written in {4:.4f} "
+            "seconds".format(filename, result['outcome'],
+                result['bytes_read'], result['bytes_written'],
+                result['seconds']))
+    if METRICS_FILENAME is not None:
+        write_metrics(filename, channel_title, result)
+    return result
+
+def json_default(value):
+    '''Returns the JSON value of the tag summary of a result, for
+    `json.dumps()`.'''
+
+    if isinstance(value, fixtags_io.TagSummary):
+        return value.as_dict()
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
+
+def write_metrics(filename, channel_title, result):
+    '''Appends the JSON line with the episode result to METRICS_FILENAME.'''
+
+    import json
+    record = {'time': time.time(), 'filename': filename,
+            'channel': channel_title}
+    record.update((key, value) for (key, value) in result.items()
+            if key not in ('diff', 'tag'))
+    with open(METRICS_FILENAME, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def write_error_metrics(filename, channel_title, error, seconds):
+    '''Appends the metrics record of the episode whose fixing failed with
+    the error after the seconds. A failure to write it is only logged.'''
 
-    elif channel_title == "The ypp's Podcast":
-        # fix some v2 tags
-        try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Янки после пьянки'
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Haskell Weekly':
-        # fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.title = episode_title
-        tag2.artist = channel_title
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Scalalaz Podcast':
-        # remove picture element from v2.2 and fix some v2 tags
+    try:
+        write_metrics(filename, channel_title, {'outcome': 'error',
+            'error': repr(error), 'seconds': seconds})
+    except OSError as e:
+        logger.error("Can't write the metrics to '{0}': {1}".format(
+            METRICS_FILENAME, e))
+
+def fix_episode_info(info):
+    '''Fixes the episode described by the dictionary with the GPODDER_*
+    keys (the values are strings as in the environment variables).'''
+
+    return fix_episode(info[FILENAME], info[EPISODE_TITLE],
+            info[CHANNEL_TITLE], int(float(info[EPISODE_PUBDATE])))
+
+def try_fix_episode_info(info):
+    '''Fixes the episode like `fix_episode_info`, but logs exceptions
+    instead of raising them.
+
+    Returns the result dictionary of `fix_episode` with the 'filename' key,
+    and the 'error' key and the 'seconds' spent if the outcome is 'error',
+    which is also recorded in METRICS_FILENAME.'''
+
+    start = time.perf_counter()
+    result = {'filename': info.get(FILENAME)}
+    try:
+        result.update(fix_episode_info(info))
+    except Exception as e:
+        logger.exception("An exception occurred with file '{0}'".format(
+            info.get(FILENAME)))
+        result['outcome'] = 'error'
+        result['error'] = repr(e)
+        result['seconds'] = time.perf_counter() - start
+        if METRICS_FILENAME is not None:
+            write_error_metrics(info.get(FILENAME), info.get(CHANNEL_TITLE),
+                    e, result['seconds'])
+    return result
+
+def read_manifest(lines):
+    '''Yields the episode info dictionaries from the JSON Lines manifest,
+    one JSON object with the GPODDER_* keys per line.'''
+
+    import json
+    for (number, line) in enumerate(lines, 1):
+        if len(line.strip()) == 0:
+            continue
         try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-            tag2.artist = 'scalalaz'
-            tag2.title = episode_title
-        tag2.picture = []
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'The World in Words':
-        # fix some v2 tags and remove v1
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.album = channel_title
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write()
-
-    elif channel_title == 'Откровенно про IT-карьеризм':
-        # fix some v2 tags and remove v1
+            yield json.loads(line)
+        except ValueError as e:
+            logger.error("Invalid manifest line {0}: {1}".format(number, e))
+            yield {'line': number}
+
+def group_by_file(infos):
+    '''Groups the episode infos by the real paths of their files, keeping
+    the order of the episodes. Returns the list of the groups.'''
+
+    groups = {}
+    for info in infos:
+        path = os.path.realpath(info.get(FILENAME) or '')
+        groups.setdefault(path, []).append(info)
+    return list(groups.values())
+
+def try_fix_episode_infos(infos):
+    '''Fixes the episodes one by one, returns the list of their results.
+
+    With PLAN and APPLY, the results of planning all the episodes are
+    followed by the results of fixing the ones that would be fixed, whose
+    tags are taken from the tag cache.'''
+
+    global PLAN
+    results = [try_fix_episode_info(info) for info in infos]
+    if PLAN and APPLY:
+        planned = [info for (info, result) in zip(infos, results)
+                if result['outcome'] == 'would fix']
+        PLAN = False
         try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.title = episode_title
-        tag2.artist = 'Михаил Марченко и Ольга Давыдова'
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        stagger.id3v1.Tag1.delete(episode_fname)
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Manager Tools':
-        # remove picture element from v2.2 and fix date
+            results.extend(try_fix_episode_info(info) for info in planned)
+        finally:
+            PLAN = True
+    return results
+
+def init_worker(padding, atomic, plan, apply, metrics_filename,
+        tag_cache_size):
+    '''Initializes a worker process of the batch pool.'''
+
+    # a forked worker inherits everything, a spawned one starts afresh
+    if isinstance(logger, DefaultLogger):
+        setup()
+    fixtags_io.PADDING = padding
+    fixtags_io.ATOMIC = atomic
+    # the batch syncs the directories at the end
+    fixtags_io.SYNC_DIRECTORY = False
+    global PLAN, APPLY, METRICS_FILENAME, TAG_CACHE_SIZE
+    PLAN = plan
+    APPLY = apply
+    METRICS_FILENAME = metrics_filename
+    TAG_CACHE_SIZE = tag_cache_size
+
+def fix_batch(infos, jobs=1):
+    '''Fixes all the episodes and returns the list of their results.
+
+    With more than one job, the episodes are fixed by a pool of `jobs`
+    processes. The episodes of the same file are always fixed by the same
+    worker in their order, so no two workers touch the same file.
+
+    With `fixtags_io.ATOMIC`, the directories of the fixed episodes are
+    synced once at the end rather than after every episode.'''
+
+    if jobs > 1:
+        import multiprocessing
+        groups = group_by_file(infos)
+        with multiprocessing.Pool(jobs, initializer=init_worker,
+                initargs=(fixtags_io.PADDING, fixtags_io.ATOMIC, PLAN, APPLY,
+                    METRICS_FILENAME, TAG_CACHE_SIZE)) as pool:
+            results = [result
+                    for group in pool.imap(try_fix_episode_infos, groups)
+                    for result in group]
+    else:
+        sync_directory = fixtags_io.SYNC_DIRECTORY
+        fixtags_io.SYNC_DIRECTORY = False
         try:
-            tag2 = stagger.read_tag(episode_fname)
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-        tag2.picture = []
-        tag2.date = episode_year
-        tag2.write(episode_fname)
-
-    elif channel_title == 'Career Tools':
-        # remove picture element from v2.2
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.picture = []
-        tag2.write()
-
-    elif channel_title == 'Debug':
-        # remove picture element from v2.2 and fix some v2 tags
-        tag2 = stagger.read_tag(episode_fname)
-        tag2.picture = []
-        tag2.title = episode_title
-        tag2.album = channel_title
-        tag2.date = episode_year
-        tag2.genre = 'Podcast'
-        tag2.write()
-
-    elif channel_title == 'Top-Thema mit Vokabeln | Deutsch lernen | Deutsche Welle':
-        # fix some v2 tags
+            results = try_fix_episode_infos(infos)
+        finally:
+            fixtags_io.SYNC_DIRECTORY = sync_directory
+        # the workers' counters stay in the workers
+        log_regex_stats()
+    if fixtags_io.ATOMIC:
+        fixtags_io.sync_directories(result['filename'] for result in results
+                if result['outcome'] == 'fixed')
+
+    outcomes = {}
+    for result in results:
+        outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+    logger.info("Processed {0} episodes: {1}; {2} bytes read, "
+        "{3} bytes written".format(len(results),
+        ', '.join('{0} {1}'.format(count, outcome)
+            for (outcome, count) in sorted(outcomes.items())),
+        sum(result.get('bytes_read', 0) for result in results),
+        sum(result.get('bytes_written', 0) for result in results)))
+    methods = {}
+    for result in results:
+        if result.get('copy_method') is not None:
+            methods[result['copy_method']] = methods.get(
+                    result['copy_method'], 0) + 1
+    if methods:
+        logger.info("Moved the audio data: {0}".format(', '.join(
+            '{0} by {1}'.format(count, method)
+            for (method, count) in sorted(methods.items()))))
+    for key in ('read_seconds', 'write_seconds', 'seconds'):
+        times = sorted(result[key] for result in results if key in result)
+        if times:
+            logger.info("{0}: p50 {1:.4f}, p95 {2:.4f}, max {3:.4f}".format(
+                key, percentile(times, 50), percentile(times, 95),
+                times[-1]))
+    return results
+
+def percentile(values, percent):
+    '''Returns the nearest-rank percentile of the sorted values.'''
+
+    import math
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+def print_results(results):
+    '''Prints the results of the batch to stdout, one JSON object per line.'''
+
+    import json
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False, default=json_default))
+
+def walk_episodes(directory):
+    '''Yields the (path, stat) pairs of the episode files in the directory
+    tree.'''
+
+    for entry in os.scandir(directory):
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_episodes(entry.path)
+        elif (entry.is_file(follow_symlinks=False) and
+                entry.name.lower().endswith(SCAN_EXTENSIONS)):
+            yield (entry.path, entry.stat(follow_symlinks=False))
+
+def read_gpodder_database(database_filename, directory):
+    '''Returns the dictionary that maps the paths of the episodes downloaded
+    to the directory to their infos from the gPodder 3 database, or an empty
+    one if there is no database.'''
+
+    import sqlite3
+    if not os.path.isfile(database_filename):
+        return {}
+    connection = sqlite3.connect(database_filename)
+    try:
+        rows = connection.execute('SELECT podcast.download_folder, '
+                'episode.download_filename, episode.title, podcast.title, '
+                'episode.published FROM episode JOIN podcast '
+                'ON episode.podcast_id = podcast.id '
+                'WHERE episode.download_filename IS NOT NULL').fetchall()
+    except sqlite3.Error as e:
+        logger.warning("Can't read the gPodder database '{0}': {1}".format(
+            database_filename, e))
+        return {}
+    finally:
+        connection.close()
+
+    infos = {}
+    for (folder, filename, episode, channel, pubdate) in rows:
+        path = os.path.join(directory, folder, filename)
+        infos[path] = {FILENAME: path, EPISODE_TITLE: episode,
+                CHANNEL_TITLE: channel, EPISODE_PUBDATE: str(pubdate)}
+    return infos
+
+def guess_episode_info(path, stat):
+    '''Returns the info of the episode file that isn't in the gPodder
+    database: the folder is the channel title, the file name is the episode
+    title and the modification time is the publication date.'''
+
+    return {
+        FILENAME: path,
+        EPISODE_TITLE: os.path.splitext(os.path.basename(path))[0],
+        CHANNEL_TITLE: os.path.basename(os.path.dirname(path)),
+        EPISODE_PUBDATE: str(int(stat.st_mtime)),
+    }
+
+def scan(directory, index_filename, database_filename=None, jobs=1):
+    '''Fixes the episodes in the gPodder downloads directory that haven't
+    been fixed by the current rules yet. Returns the list of their results.
+
+    The index file is an SQLite database with the size, modification time
+    and the rules hash of every episode after it was fixed. The rules hash is
+    the hash of the episode's rule, or the hash of the whole rules file if
+    there was no rule (a new rule may be for the episode). The episodes
+    that haven't changed since then and whose rule hasn't changed either
+    are skipped after a stat(), so a rule change refixes only the episodes
+    of its channels. The episode
+    infos come from the gPodder database (by default, 'Database' next to
+    the directory), or are guessed from the paths.'''
+
+    import sqlite3
+    directory = os.path.abspath(directory)
+    if database_filename is None:
+        database_filename = os.path.join(os.path.dirname(directory),
+                'Database')
+
+    index = sqlite3.connect(index_filename)
+    try:
+        index.execute('CREATE TABLE IF NOT EXISTS episodes (path TEXT '
+                'PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                'rules_hash TEXT, outcome TEXT)')
+        known = dict((row[0], row[1:]) for row in index.execute(
+            'SELECT path, size, mtime_ns, rules_hash FROM episodes'))
+
+        reload_rules()
+        hashes = set(RULE_HASHES.values())
+        hashes.add(RULES_HASH)
+
+        # the database is read only if there's something to fix
+        database = None
+        seen = set()
+        infos = []
+        for (path, stat) in walk_episodes(directory):
+            seen.add(path)
+            row = known.get(path)
+            if (row is not None and row[0:2] == (stat.st_size,
+                    stat.st_mtime_ns) and row[2] in hashes):
+                continue
+            if database is None:
+                database = read_gpodder_database(database_filename, directory)
+            infos.append(database.get(path) or guess_episode_info(path, stat))
+        logger.info("Scanned {0} files in '{1}', {2} to fix".format(
+            len(seen), directory, len(infos)))
+
+        results = fix_batch(infos, jobs) if infos else []
+
+        # the errors are retried next time, and nothing is fixed by a plan
+        # unless it's applied
+        rows = []
+        for result in results:
+            if (result['outcome'] not in ('error', 'would fix') and
+                    (APPLY or not PLAN)):
+                stat = os.stat(result['filename'])
+                rows.append((result['filename'], stat.st_size,
+                    stat.st_mtime_ns,
+                    RULE_HASHES.get(result['rule'], RULES_HASH),
+                    result['outcome']))
+        index.executemany('INSERT OR REPLACE INTO episodes '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+        # forget the deleted episodes
+        index.executemany('DELETE FROM episodes WHERE path = ?',
+                ((path,) for path in known
+                    if path.startswith(directory + os.sep) and
+                    path not in seen))
+        index.commit()
+    finally:
+        index.close()
+    return results
+
+def serve(socket_path, idle_timeout=None):
+    '''Runs the fixtags daemon on the unix socket.
+
+    The daemon keeps stagger and the rules loaded (the rules are reloaded
+    when the rules file changes), and fixes the episodes sent by the gPodder
+    extension. A request is a line with a JSON object with the GPODDER_*
+    keys, the reply is a line with the JSON result of `try_fix_episode_info`,
+    or with the 'error' outcome if the rules can't be loaded.
+    The daemon exits if there are no requests for `idle_timeout` seconds.
+    '''
+
+    import json
+    import socket
+    import socketserver
+    import stagger
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    info = json.loads(line.decode('utf-8'))
+                except ValueError as e:
+                    reply = {'outcome': 'error', 'error': repr(e)}
+                else:
+                    try:
+                        if reload_rules():
+                            logger.info("Reloaded the rules from '{0}'"
+                                    .format(RULES_FILENAME))
+                    except Exception as e:
+                        logger.exception("Couldn't load the rules from "
+                                "'{0}'".format(RULES_FILENAME))
+                        reply = {'filename': info.get(FILENAME),
+                                'outcome': 'error', 'error': repr(e)}
+                    else:
+                        reply = try_fix_episode_info(info)
+                self.wfile.write(json.dumps(reply,
+                    default=json_default).encode('utf-8') + b'\n')
+
+    class Server(socketserver.UnixStreamServer):
+        idle = False
+
+        def handle_timeout(self):
+            self.idle = True
+
+    # a stale socket from a killed daemon prevents binding
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            tag2 = stagger.read_tag(episode_fname)
-            try:
-                del tag2['APIC']
-            except KeyError:
-                pass
-        except stagger.errors.NoTagError:
-            tag2 = stagger.Tag24()
-            tag2.title = episode_title
-            tag2.artist = 'Deutsche Welle'
-            tag2.album = channel_title
-            tag2.date = episode_year
-            tag2.genre = 'Podcast'
-        tag2.write(episode_fname)
-
-    elif ((channel_title == 'UWP - Eженедельный подкаст от Umputun')
-            or (channel_title == 'Discovery')
-            or (channel_title == 'Охотник За Головами - Денис aka Radio Grinch')
-            or (channel_title == 'The Java Posse')
-            or (channel_title == 'Эксперт-шоу Рунетология')
-            or (channel_title == 'The Skeptics Guide to the Universe')
-            or (channel_title == 'this WEEK in TECH')
-            or (channel_title == 'Radio Grinch')
-            or (channel_title == 'Adam Curry\'s Daily Source Code')
-            or (channel_title == 'Friends House')
-            or (channel_title == 'Security Now!')
-            or (channel_title == 'Build Phase')
-            or (channel_title == 'TechSNAP MP3')
-            or (channel_title == 'Triangulation (MP3)')
-            or (channel_title == 'Slow German')
-            or (channel_title == 'CoRecursive w/ Adam Bell')
-            or (channel_title == 'Reply All')
-            or (channel_title == 'LINUX Unplugged')
-            or (channel_title == 'Hackaday Podcast')
-            or (channel_title == 'Радио-Т Поток')
-            or (channel_title == 'Пиратский Канадский Лось и компания')
-            ):
-        # nothing to fix here
-        pass
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+        else:
+            logger.error("Another fixtags daemon is running on '{0}'".format(
+                socket_path))
+            return
+        finally:
+            probe.close()
+
+    server = Server(socket_path, Handler)
+    server.timeout = idle_timeout
+    logger.info("fixtags daemon is listening on '{0}'".format(socket_path))
+    try:
+        while not server.idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        log_regex_stats()
+    logger.info("fixtags daemon exits after {0} idle seconds".format(
+        idle_timeout))
+
+def parse_args():
+    '''Parses the command line arguments.
+
+    Without a command the script fixes one episode described by the GPODDER_*
+    environment variables, as gPodder 2 runs it.'''
+
+    # gPodder 2 runs the script without arguments, which needs no argparse
+    if len(sys.argv) == 1:
+        import types
+        return types.SimpleNamespace(command=None, padding=fixtags_io.PADDING,
+                atomic=False, plan=False, apply=False, metrics=None,
+                tag_cache=None)
+
+    import argparse
+    parser = argparse.ArgumentParser(
+            description='Fixes podcasts\' mp3 tags after downloading.')
+    parser.add_argument('--padding', type=int, default=fixtags_io.PADDING,
+            help='bytes of padding to reserve when a tag has to grow '
+            '(default: {0})'.format(fixtags_io.PADDING))
+    parser.add_argument('--atomic', action='store_true',
+            help='write a file whose audio data has to be moved to a temporary '
+            'file and rename it over the episode, so that a crash doesn\'t '
+            'corrupt it')
+    parser.add_argument('--plan', action='store_true',
+            help='print the tag changes as JSON instead of writing them')
+    parser.add_argument('--apply', action='store_true',
+            help='with --plan, fix the episodes of the batch or scan after '
+            'printing their plan, parsing every tag once')
+    parser.add_argument('--metrics', default=None,
+            help='append a JSON line with the result and timings of every '
+            'episode to the file')
+    parser.add_argument('--tag-cache', type=float, default=None,
+            help='MB of memory the parsed tags may take between --plan and '
+            '--apply, 0 to turn the cache off (default: {0:g} with --apply, '
+            'otherwise 0)'.format(APPLY_TAG_CACHE_SIZE / (1 << 20)))
+    commands = parser.add_subparsers(dest='command')
+
+    daemon = commands.add_parser('daemon',
+            help='fix the episodes sent to a unix socket')
+    daemon.add_argument('socket', help='path to the unix socket')
+    daemon.add_argument('--idle-timeout', type=float, default=None,
+            help='exit after so many seconds without requests')
+
+    batch = commands.add_parser('batch',
+            help='fix the episodes listed in a JSON Lines manifest')
+    batch.add_argument('manifest', nargs='?', default='-',
+            help='manifest file with one JSON object with the GPODDER_* keys '
+            'per line (default: stdin)')
+    batch.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of worker processes (default: 1)')
+
+    scanner = commands.add_parser('scan',
+            help='fix the new and changed episodes in a gPodder downloads '
+            'directory')
+    scanner.add_argument('directory', help='gPodder downloads directory')
+    scanner.add_argument('--index', default=SCAN_INDEX_FILENAME,
+            help='SQLite index of the fixed episodes (default: {0})'.format(
+                SCAN_INDEX_FILENAME))
+    scanner.add_argument('--database', default=None,
+            help='gPodder database with the episode infos (default: '
+            'Database next to the directory)')
+    scanner.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of worker processes (default: 1)')
+
+    args = parser.parse_args()
+    if args.apply and not (args.plan and args.command in ('batch', 'scan')):
+        parser.error('--apply needs --plan and the batch or scan command')
+    return args
 
-    else: logger.info("No fixes for the episode. GPODDER_CHANNEL_TITLE='{0}' "
-            "GPODDER_EPISODE_TITLE='{1}' GPODDER_EPISODE_FILENAME='{2}' "
-            "GPODDER_EPISODE_PUBDATE='{3}'".format(channel_title,
-                episode_title, episode_fname, episode_pubdate))
+def main():
+    # get episode info from the environment variables
+    global episode_title, episode_fname, channel_title, episode_pubdate
+    try:
+        episode_title = os.environ[EPISODE_TITLE]
+        episode_fname = os.environ[FILENAME]
+        channel_title = os.environ[CHANNEL_TITLE]
+        episode_pubdate = int(float(os.environ[EPISODE_PUBDATE]))
+    except KeyError:
+        print("""This script should be run by gPodder. Put its path and filename ({0}) as the argument to 'cmd_download_complete' option.
+For more information, go to 'http://wiki.gpodder.org/wiki/User_Manual#Time_stretching_.28making_playback_slower_or_faster.29', the 'Using the post-download script hook' section.""".format(os.path.abspath(sys.argv[0])), file=sys.stderr)
+        raise WrongInvocationError()
+    #print('Processing {0}'.format(episode_fname))
+
+    # the rule is found first so that the episodes with nothing to fix don't
+    # wait for the logging and stagger
+    rule = find_rule(channel_title)
+    if rule is not None and rule['tag'] is None and METRICS_FILENAME is None:
+        return new_result('nothing to fix')
+
+    if isinstance(logger, DefaultLogger):
+        setup()
+    start = time.perf_counter()
+    try:
+        return fix_episode(episode_fname, episode_title, channel_title,
+                episode_pubdate)
+    except Exception as e:
+        if METRICS_FILENAME is not None:
+            write_error_metrics(episode_fname, channel_title, e,
+                    time.perf_counter() - start)
+        raise
 
 if __name__ == '__main__':
+    args = parse_args()
+    results = []
+    fixtags_io.PADDING = args.padding
+    fixtags_io.ATOMIC = args.atomic
+    PLAN = args.plan
+    APPLY = args.apply
+    METRICS_FILENAME = args.metrics
+    if args.tag_cache is not None:
+        TAG_CACHE_SIZE = int(args.tag_cache * (1 << 20))
+    elif APPLY:
+        TAG_CACHE_SIZE = APPLY_TAG_CACHE_SIZE
     try:
-        setup()
-        main()
+        # the legacy mode sets up the app when it knows there's work to do
+        if args.command is not None:
+            setup()
+        if args.command == 'daemon':
+            serve(args.socket, args.idle_timeout)
+        elif args.command == 'batch':
+            import stagger
+            if args.manifest == '-':
+                infos = list(read_manifest(sys.stdin))
+            else:
+                with open(args.manifest, encoding='utf-8') as manifest:
+                    infos = list(read_manifest(manifest))
+            # a broken rules file fails the batch once, not every episode
+            reload_rules()
+            results = fix_batch(infos, args.jobs)
+            print_results(results)
+        elif args.command == 'scan':
+            import stagger
+            results = scan(args.directory, args.index, args.database,
+                    args.jobs)
+            print_results(results)
+        else:
+            result = main()
+            if PLAN and result is not None:
+                results = [result]
+                print_results(results)
     except ImportError:
+        if isinstance(logger, DefaultLogger):
+            setup()
         logger.critical("Couldn't import stagger! Please fix. GPODDER_CHANNEL_TITLE='{0}' "
             "GPODDER_EPISODE_TITLE='{1}' GPODDER_EPISODE_FILENAME='{2}' "
             "GPODDER_EPISODE_PUBDATE='{3}'".format(channel_title,
@@ -1203,6 +1275,9 @@ if __name__ == '__main__':
         # if happens something that we didn't foresee,
         # print traceback to the log
         import traceback
+        if isinstance(logger, DefaultLogger):
+            setup()
         logger.exception("An exception occurred with file '{}'".format(episode_fname))
         sys.exit(2)
-
+    if any(result['outcome'] == 'error' for result in results):
+        sys.exit(2)
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+# Author: pluton <pluton.od (at) gmail.com>
+# License: GPL v3
+
+'''Benchmarks fixtags.py on synthetic episode files.
+
+Every scenario generates a corpus of fake MP3 files (any sizes, ID3v2.2,
+v2.3 or v2.4 tags, with or without an ID3v1 tag, with or without artwork,
+with or without padding), and fixes all of them with a real rule in its own
+process. The results are files per second, bytes read and written, and the
+peak RSS of the process; they can be saved as a JSON baseline and compared
+with one later, which fails if any of them got worse than the tolerance.
+
+The 'startup' scenario runs the script the way gPodder 2 does for an episode
+with nothing to fix, and checks how much slower it starts than the bare
+interpreter against STARTUP_TARGET.
+
+The 'crash' scenario kills the process fixing an episode at random moments
+and counts the episodes left corrupted, which must be none with --atomic.
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import fixtags
+import fixtags_io
+
+# The scenarios: the name, the description, and the channel whose rule is
+# used.
+SCENARIOS = [
+    ('new', 'create a new v2.4 tag', 'EconTalk'),
+    ('read_modify_write', 'read the tag and change some frames',
+        'Stacktrace'),
+    ('delete_v1', 'read the tag, change it and delete the v1 tag',
+        'Science Friday'),
+    ('strip_picture', 'read the tag and delete the artwork',
+        'Career Tools'),
+]
+
+# the channel of the startup scenario, whose rule has nothing to fix
+STARTUP_CHANNEL = 'Security Now!'
+# how much longer than the bare interpreter the script may take to start, in
+# seconds
+STARTUP_TARGET = 0.03
+
+# The measurements compared with the baseline, and whether they are better
+# when they are higher.
+COMPARED = [
+    ('files_per_sec', True),
+    ('bytes_read', False),
+    ('bytes_written', False),
+    ('peak_rss', False),
+]
+
+# the channel of the crash scenario, whose new tag moves all the audio data
+CRASH_CHANNEL = 'EconTalk'
+
+# the tag classes of the corpus
+TAG_VERSIONS = (2, 3, 4)
+# size of the artwork, when there is one
+PICTURE_SIZE = 200 * 1024
+# the paddings of the corpus tags
+PADDINGS = (0, 4096)
+# the audio data is made of this block
+AUDIO_BLOCK = (b'\xff\xfb\x90\x64' + bytes(range(256)) * 4) * 64
+
+
+def make_tag(version, picture):
+    '''Returns the typical podcast tag of the version.'''
+
+    import stagger
+    tag = {2: stagger.Tag22, 3: stagger.Tag23, 4: stagger.Tag24}[version]()
+    tag.title = 'Episode 1: Something interesting'
+    tag.artist = 'Somebody'
+    tag.album = 'Some podcast'
+    tag.date = '2013'
+    tag.comment = 'Some description of the episode. ' * 10
+    if picture:
+        data = bytes(PICTURE_SIZE)
+        if version == 2:
+            tag[stagger.id3.PIC] = stagger.id3.PIC(format='JPG', type=3,
+                    desc='', data=data)
+        else:
+            tag[stagger.id3.APIC] = stagger.id3.APIC(mime='image/jpeg',
+                    type=3, desc='', data=data)
+    return tag
+
+def write_episode(filename, size, version, v1, picture, padding):
+    '''Writes the fake episode file with the audio data of the size.'''
+
+    tag = make_tag(version, picture)
+    tag.padding_default = padding
+    with open(filename, 'wb') as file:
+        file.write(tag.encode())
+        left = size
+        while left > 0:
+            left -= file.write(AUDIO_BLOCK[:left])
+        if v1:
+            file.write(b'TAG' + b'Episode 1'.ljust(30, b'\0') +
+                    bytes(125 - 30))
+
+def make_corpus(directory, channel, sizes, copies):
+    '''Writes the corpus of every combination of the sizes (in bytes), tag
+    versions, v1 tags, artwork and paddings to the directory. Returns the
+    list of the episode infos for fixtags.'''
+
+    infos = []
+    for size in sizes:
+        for version in TAG_VERSIONS:
+            for v1 in (False, True):
+                for picture in (False, True):
+                    for padding in PADDINGS:
+                        for copy in range(copies):
+                            filename = os.path.join(directory,
+                                    '{0}-{1}-{2}-{3}-{4}-{5}.mp3'.format(
+                                        size, version, int(v1), int(picture),
+                                        padding, copy))
+                            write_episode(filename, size, version, v1,
+                                    picture, padding)
+                            infos.append({
+                                fixtags.FILENAME: filename,
+                                fixtags.EPISODE_TITLE: 'Episode 1',
+                                fixtags.CHANNEL_TITLE: channel,
+                                fixtags.EPISODE_PUBDATE: '1370000000',
+                            })
+    return infos
+
+def run_scenario(infos, queue):
+    '''Fixes the episodes and puts the measurements to the queue. Runs in
+    a separate process so that the peak RSS is the scenario's own.'''
+
+    fixtags.logger = logging.getLogger('fixtags')
+    fixtags.logger.addHandler(logging.NullHandler())
+    fixtags.logger.propagate = False
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    results = fixtags.fix_batch(infos)
+    seconds = time.perf_counter() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    methods = {}
+    for result in results:
+        if result.get('copy_method') is not None:
+            methods[result['copy_method']] = methods.get(
+                    result['copy_method'], 0) + 1
+
+    queue.put({
+        'files': len(results),
+        'errors': sum(1 for result in results
+            if result['outcome'] == 'error'),
+        'seconds': seconds,
+        'files_per_sec': len(results) / seconds if seconds > 0 else 0,
+        'bytes_read': sum(result.get('bytes_read', 0) for result in results),
+        'bytes_written': sum(result.get('bytes_written', 0)
+            for result in results),
+        'cpu_seconds': (end_usage.ru_utime - usage.ru_utime +
+            end_usage.ru_stime - usage.ru_stime),
+        'copy_methods': methods,
+        # kilobytes on Linux, bytes on OS X
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+def benchmark(scenarios, sizes, copies, directory=None):
+    '''Runs the scenarios, returns the dictionary of their measurements.'''
+
+    context = multiprocessing.get_context('fork')
+    measurements = {}
+    for (name, description, channel) in scenarios:
+        with tempfile.TemporaryDirectory(dir=directory) as corpus:
+            infos = make_corpus(corpus, channel, sizes, copies)
+            queue = context.Queue()
+            process = context.Process(target=run_scenario,
+                    args=(infos, queue))
+            process.start()
+            measurements[name] = queue.get()
+            process.join()
+    return measurements
+
+def time_command(args, env, runs):
+    '''Runs the command `runs` times. Returns the sorted list of the wall
+    times and the number of failed runs.'''
+
+    times = []
+    failures = 0
+    for run in range(runs):
+        start = time.perf_counter()
+        if subprocess.call(args, env=env) != 0:
+            failures += 1
+        times.append(time.perf_counter() - start)
+    return (sorted(times), failures)
+
+def benchmark_startup(runs):
+    '''Measures the startup of the script for an episode with nothing to
+    fix. Returns the measurements with the 'median_seconds' of a run and the
+    'overhead_seconds' over the bare interpreter.'''
+
+    env = dict(os.environ)
+    env.update({
+        fixtags.FILENAME: os.devnull,
+        fixtags.EPISODE_TITLE: 'Episode 1',
+        fixtags.CHANNEL_TITLE: STARTUP_CHANNEL,
+        fixtags.EPISODE_PUBDATE: '1370000000',
+    })
+    (bare, failures) = time_command([sys.executable, '-c', 'pass'], env, runs)
+    (times, failures) = time_command([sys.executable, fixtags.__file__], env,
+            runs)
+    median = times[len(times) // 2]
+    return {
+        'files': runs,
+        'errors': failures,
+        'seconds': sum(times),
+        'files_per_sec': runs / sum(times),
+        'bytes_read': 0,
+        'bytes_written': 0,
+        'peak_rss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'median_seconds': median,
+        'overhead_seconds': median - bare[len(bare) // 2],
+    }
+
+def fix_and_exit(info):
+    '''Fixes the episode in a child process of the crash scenario.'''
+
+    fixtags.logger = logging.getLogger('fixtags')
+    fixtags.logger.addHandler(logging.NullHandler())
+    fixtags.logger.propagate = False
+    fixtags.fix_episode_info(info)
+
+def benchmark_crash(size, runs, directory=None):
+    '''Kills the fixing of an episode without a tag (so all its audio data is
+    moved) at random moments. Returns the measurements where the 'errors'
+    are the episodes whose audio data was damaged.'''
+
+    import random
+    import signal
+    context = multiprocessing.get_context('fork')
+    audio = (AUDIO_BLOCK * (size // len(AUDIO_BLOCK) + 1))[:size]
+    with tempfile.TemporaryDirectory(dir=directory) as corpus:
+        filename = os.path.join(corpus, 'crash.mp3')
+        info = {
+            fixtags.FILENAME: filename,
+            fixtags.EPISODE_TITLE: 'Episode 1',
+            fixtags.CHANNEL_TITLE: CRASH_CHANNEL,
+            fixtags.EPISODE_PUBDATE: '1370000000',
+        }
+
+        # how long an uninterrupted fix takes
+        with open(filename, 'wb') as file:
+            file.write(audio)
+        start = time.perf_counter()
+        process = context.Process(target=fix_and_exit, args=(info,))
+        process.start()
+        process.join()
+        duration = time.perf_counter() - start
+
+        damaged = 0
+        start = time.perf_counter()
+        for run in range(runs):
+            with open(filename, 'wb') as file:
+                file.write(audio)
+            process = context.Process(target=fix_and_exit, args=(info,))
+            process.start()
+            time.sleep(random.uniform(0, duration))
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+            with open(filename, 'rb') as file:
+                data = file.read()
+            if data[fixtags_io.id3v2_length(data[:10]):] != audio:
+                damaged += 1
+        seconds = time.perf_counter() - start
+    return {
+        'files': runs,
+        'errors': damaged,
+        'seconds': seconds,
+        'files_per_sec': runs / seconds,
+        'bytes_read': 0,
+        'bytes_written': 0,
+        'peak_rss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+def worse(value, base, higher_better, tolerance):
+    '''Returns whether the value is worse than the baseline one by more than
+    the tolerance.'''
+
+    if higher_better:
+        return value < base * (1 - tolerance)
+    return value > base * (1 + tolerance)
+
+def compare(measurements, baseline, tolerance):
+    '''Prints the measurements, with the baseline ones under them. Returns
+    the list of the '<scenario> <measurement>' names of the COMPARED
+    measurements worse than the baseline by more than the tolerance.'''
+
+    regressions = []
+    row = '{0:<20} {1:>10} {2:>14} {3:>14} {4:>10} {5:>8}{6}'
+    print(row.format('scenario', 'files/s', 'bytes read', 'bytes written',
+        'peak RSS', 'CPU s', ''))
+    for (name, result) in measurements.items():
+        cpu = ''
+        if 'cpu_seconds' in result:
+            cpu = '{0:.2f}'.format(result['cpu_seconds'])
+        print(row.format(name, '{0:.1f}'.format(result['files_per_sec']),
+            result['bytes_read'], result['bytes_written'],
+            result['peak_rss'], cpu,
+            ' ({0} errors)'.format(result['errors'])
+                if result['errors'] else ''))
+
+        base = baseline.get(name)
+        if base is None:
+            continue
+        worse_keys = []
+        for (key, higher_better) in COMPARED:
+            # the speed of the crash scenario depends on when the kills happen
+            if key == 'files_per_sec' and name == 'crash':
+                continue
+            if key in base and worse(result[key], base[key], higher_better,
+                    tolerance):
+                worse_keys.append(key)
+                regressions.append('{0} {1}'.format(name, key))
+        print(row.format('  baseline', '{0:.1f}'.format(
+            base['files_per_sec']), base['bytes_read'],
+            base['bytes_written'], base['peak_rss'], '',
+            ' (worse: {0})'.format(', '.join(worse_keys))
+                if worse_keys else ''))
+    return regressions
+
+def parse_args():
+    '''Parses the command line arguments.'''
+
+    parser = argparse.ArgumentParser(
+            description='Benchmarks fixtags.py on synthetic episode files.')
+    parser.add_argument('--scenario', action='append',
+            choices=['startup', 'crash'] +
+                [name for (name, description, channel) in SCENARIOS],
+            help='scenario to run (default: all)')
+    parser.add_argument('--startup-runs', type=int, default=20,
+            help='runs of the startup scenario (default: 20)')
+    parser.add_argument('--crash-runs', type=int, default=20,
+            help='runs of the crash scenario (default: 20)')
+    parser.add_argument('--atomic', action='store_true',
+            help='write the files like fixtags.py --atomic')
+    parser.add_argument('--size', type=float, action='append',
+            help='size of the audio data in MB (default: 1 and 4)')
+    parser.add_argument('--copies', type=int, default=1,
+            help='files of every kind in the corpus (default: 1)')
+    parser.add_argument('--dir', default=None,
+            help='directory for the corpus (default: the temp directory)')
+    parser.add_argument('--baseline',
+            help='JSON file of the measurements to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+            help='allowed slowdown, and growth of the bytes read and written '
+            'and the peak RSS, relative to the baseline (default: 0.1)')
+    parser.add_argument('--save',
+            help='save the measurements to the JSON file as a baseline')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    scenarios = [scenario for scenario in SCENARIOS
+            if args.scenario is None or scenario[0] in args.scenario]
+    sizes = [int(size * 1024 * 1024) for size in (args.size or [1, 4])]
+
+    fixtags_io.ATOMIC = args.atomic
+    measurements = {}
+    # first, so that the peak RSS of the children is the script's
+    if args.scenario is None or 'startup' in args.scenario:
+        measurements['startup'] = benchmark_startup(args.startup_runs)
+    measurements.update(benchmark(scenarios, sizes, args.copies, args.dir))
+    if args.scenario is None or 'crash' in args.scenario:
+        measurements['crash'] = benchmark_crash(max(sizes), args.crash_runs,
+                args.dir)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['scenarios']
+    regressions = compare(measurements, baseline, args.tolerance)
+    if 'startup' in measurements:
+        startup = measurements['startup']
+        print('startup: {0:.1f} ms, {1:.1f} ms more than the bare interpreter '
+                '(target: {2:.1f} ms)'.format(
+                    startup['median_seconds'] * 1000,
+                    startup['overhead_seconds'] * 1000,
+                    STARTUP_TARGET * 1000))
+        if startup['overhead_seconds'] > STARTUP_TARGET:
+            regressions.append('startup target')
+
+    if measurements.get('crash', {}).get('errors') and args.atomic:
+        print('Damaged by the crashes: {0} of {1} episodes'.format(
+            measurements['crash']['errors'], measurements['crash']['files']))
+        regressions.append('crash')
+
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump({'python': sys.version, 'atomic': args.atomic,
+                'sizes': sizes,
+                'copies': args.copies, 'scenarios': measurements}, file,
+                indent=4, sort_keys=True)
+    if regressions:
+        print('Worse than the baseline or the target: {0}'.format(
+            ', '.join(regressions)))
+        sys.exit(1)
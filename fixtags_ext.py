@@ -1,7 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import json
+import socket
+import threading
+import time
 from subprocess import Popen, PIPE
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
 
 import gpodder
 
@@ -18,12 +31,35 @@ __category__ = 'post-download'
 # Keys for the extension's config
 class ConfigKey:
     FIXTAGS_CMD = 'fixtags_cmd'
+    FIXTAGS_SOCKET = 'fixtags_socket'
+    FIXTAGS_BATCH_WINDOW = 'fixtags_batch_window'
+    FIXTAGS_BATCH_SIZE = 'fixtags_batch_size'
 
 # Sets the extension's config with default options.
 DefaultConfig = {
-    ConfigKey.FIXTAGS_CMD: ''
+    ConfigKey.FIXTAGS_CMD: '',
+    # the unix socket of the fixtags daemon; empty to run fixtags.py for
+    # every episode
+    ConfigKey.FIXTAGS_SOCKET: '~/.fixtags.sock',
+    # the episodes downloaded within so many seconds after the first one are
+    # fixed together, up to the batch size
+    ConfigKey.FIXTAGS_BATCH_WINDOW: 2.0,
+    ConfigKey.FIXTAGS_BATCH_SIZE: 20
 }
 
+# The daemon started by the extension exits after so many idle seconds.
+DAEMON_IDLE_TIMEOUT = 600
+# How long to wait for a just started daemon, in seconds.
+DAEMON_START_TIMEOUT = 5
+# How long to wait for the daemon to fix one episode, in seconds.
+DAEMON_REQUEST_TIMEOUT = 300
+# How many downloaded episodes may wait to be fixed in the background.
+# The episodes downloaded while the queue is full aren't fixed.
+QUEUE_SIZE = 100
+# How long gPodder waits for the queued episodes to be fixed when it quits,
+# in seconds. The ones that aren't fixed by then are logged.
+UNLOAD_TIMEOUT = 30
+
 
 # Keys for the internal info dictionary.
 class Key:
@@ -38,9 +74,20 @@ class gPodderExtension:
     # you want to prevent the extension from being loaded.
     def __init__(self, container):
         self.container = container
+        # the episode infos to fix, and None to stop the worker
+        self.queue = Queue(QUEUE_SIZE)
+        self.worker = None
+        self.worker_lock = threading.Lock()
+        # the episode infos the worker is fixing now
+        self.batch = []
+        # the fixtags module imported for the command, or None if it can't
+        # be imported by this python
+        self.engine = None
+        self.engine_cmd = None
 
     # This function is called when an episode has been downloaded.
     # The episode param is a gpodder.model.PodcastEpisode instance.
+    # The episode is fixed in the background so that gPodder doesn't wait.
     def on_episode_downloaded(self, episode):
         info = self.get_episode_info(episode)
         logger.info(u'on_episode_downloaded (filename="%s", '
@@ -51,30 +98,233 @@ class gPodderExtension:
                     info[Key.CHANNEL_TITLE],
                     info[Key.EPISODE_PUBDATE]))
 
+        try:
+            self.queue.put_nowait(info)
+        except Full:
+            logger.error(u'fixtags queue is full, "%s" is not fixed' %
+                    info[Key.FILENAME])
+            return
+        self.start_worker()
+
+    # This function is called when the extension is disabled or gPodder
+    # quits. The worker stops after the episodes already in the queue; they
+    # are waited for up to UNLOAD_TIMEOUT seconds, and the ones left unfixed
+    # are logged.
+    def on_unload(self):
+        with self.worker_lock:
+            worker = self.worker
+        if (worker is None) or not worker.is_alive():
+            return
+        deadline = time.time() + UNLOAD_TIMEOUT
+        try:
+            self.queue.put(None, timeout=UNLOAD_TIMEOUT)
+        except Full:
+            logger.error(u'fixtags worker can\'t be stopped, the queue is full')
+        worker.join(max(0, deadline - time.time()))
+        if not worker.is_alive():
+            return
+
+        for info in list(self.batch):
+            logger.error(u'fixtags is still fixing "%s", it may be left '
+                    u'broken' % info[Key.FILENAME])
+        while True:
+            try:
+                info = self.queue.get_nowait()
+            except Empty:
+                break
+            if info is not None:
+                logger.error(u'fixtags didn\'t fix "%s" before unloading' %
+                        info[Key.FILENAME])
+        # the worker still stops after the current batch
+        self.queue.put_nowait(None)
+
+    # Starts the background thread fixing the queued episodes unless it's
+    # already running.
+    def start_worker(self):
+        with self.worker_lock:
+            if (self.worker is None) or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.process_queue,
+                        name='fixtags')
+                # don't keep gPodder from quitting
+                self.worker.daemon = True
+                self.worker.start()
+
+    # Fixes the queued episodes in batches until it gets None.
+    def process_queue(self):
+        while True:
+            info = self.queue.get()
+            if info is None:
+                return
+            (infos, stop) = self.collect_batch(info)
+            self.batch = infos
+            try:
+                self.fix_episodes(infos)
+            except Exception:
+                logger.exception(u'failed to fix %d episodes' % len(infos))
+            self.batch = []
+            if stop:
+                return
+
+    # Collects the episodes queued within the batch window after the first
+    # one, up to the batch size. Returns the list of the episode infos and
+    # whether the worker should stop after them.
+    def collect_batch(self, info):
+        infos = [info]
+        window = float(self.container.config.fixtags_batch_window)
+        size = int(self.container.config.fixtags_batch_size)
+        deadline = time.time() + window
+        while len(infos) < size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                info = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if info is None:
+                return (infos, True)
+            infos.append(info)
+        return (infos, False)
+
+    # Fixes the episodes with the fixtags daemon or the fixtags command.
+    def fix_episodes(self, infos):
         rawcmd = self.container.config.fixtags_cmd
         if (rawcmd is not None) and (len(rawcmd) > 0):
             cmd = os.path.expanduser(rawcmd)
-            self.run_external_command(cmd, info)
+            engine = self.load_engine(cmd)
+            if engine is not None:
+                self.fix_in_process(engine, infos)
+                return
+            rawsocket = self.container.config.fixtags_socket
+            if (rawsocket is not None) and (len(rawsocket) > 0):
+                socket_path = os.path.expanduser(rawsocket)
+                if self.send_to_daemon(cmd, socket_path, infos):
+                    return
+            if len(infos) == 1:
+                self.run_external_command(cmd, infos[0])
+            else:
+                self.run_batch_command(cmd, infos)
         else:
             logger.warn(u'External command (key "%s.%s" in config) is not set' %
                     (self.container.config._name, ConfigKey.FIXTAGS_CMD))
 
+    # Returns the fixtags module if the command is the path of fixtags.py
+    # and this python can import it along with stagger, otherwise None.
+    # The import is tried once per command.
+    def load_engine(self, cmd):
+        if cmd == self.engine_cmd:
+            return self.engine
+        self.engine_cmd = cmd
+        self.engine = None
+        if not os.path.isfile(cmd):
+            return None
+
+        sys.path.insert(0, os.path.dirname(os.path.abspath(cmd)))
+        try:
+            import stagger
+            import fixtags
+        except Exception as e:
+            logger.info(u'fixtags can\'t be imported, it will be run as '
+                    u'a command: %s' % e)
+            return None
+        finally:
+            del sys.path[0]
+        fixtags.logger = logging.getLogger(__name__ + '.fixtags')
+        logger.info(u'fixtags is imported from "%s"' % fixtags.__file__)
+        self.engine = fixtags
+        return fixtags
+
+    # Fixes the episodes with the imported fixtags module.
+    def fix_in_process(self, engine, infos):
+        if engine.reload_rules():
+            logger.info(u'fixtags rules are reloaded')
+        for info in infos:
+            result = engine.try_fix_episode_info(info)
+            self.log_result(u'fixtags', info[Key.FILENAME], result)
+
+    # Sends the episode infos to the fixtags daemon listening on the socket,
+    # starting the daemon with the command if it isn't running yet.
+    # Returns False if the daemon isn't available or the episodes can't be
+    # sent. Once they are sent, the daemon may be fixing them, so the ones
+    # it doesn't answer for are logged rather than fixed again.
+    def send_to_daemon(self, cmd, socket_path, infos):
+        sock = self.connect_daemon(socket_path)
+        if sock is None:
+            self.start_daemon(cmd, socket_path)
+            deadline = time.time() + DAEMON_START_TIMEOUT
+            while (sock is None) and (time.time() < deadline):
+                time.sleep(0.1)
+                sock = self.connect_daemon(socket_path)
+            if sock is None:
+                logger.warn(u'fixtags daemon on "%s" is not available' %
+                        socket_path)
+                return False
+
+        try:
+            try:
+                sock.sendall(b''.join(
+                    (json.dumps(info) + '\n').encode('utf-8')
+                    for info in infos))
+            except socket.error as e:
+                logger.error(u'fixtags daemon on "%s" failed: %s' %
+                        (socket_path, e))
+                return False
+
+            replies = sock.makefile('rb')
+            for (number, info) in enumerate(infos):
+                try:
+                    result = json.loads(replies.readline().decode('utf-8'))
+                except (socket.error, ValueError) as e:
+                    logger.error(u'fixtags daemon on "%s" failed: %s' %
+                            (socket_path, e))
+                    for info in infos[number:]:
+                        logger.error(u'fixtags daemon didn\'t answer for '
+                                u'"%s", it may be fixed or not' %
+                                info[Key.FILENAME])
+                    break
+                self.log_result(u'fixtags daemon', info[Key.FILENAME],
+                        result)
+        finally:
+            sock.close()
+        return True
+
+    # Logs the result of fixing the episode file.
+    def log_result(self, fixer, filename, result):
+        if result.get('outcome') == 'error':
+            logger.error(u'%s failed to fix "%s": %s' %
+                    (fixer, filename, result.get('error')))
+        else:
+            logger.info(u'%s: "%s" %s' %
+                    (fixer, filename, result.get('outcome')))
+
+    # Returns a socket connected to the fixtags daemon or None if the daemon
+    # isn't running.
+    def connect_daemon(self, socket_path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(DAEMON_REQUEST_TIMEOUT)
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            sock.close()
+            return None
+        return sock
+
+    # Starts the fixtags daemon in the background.
+    def start_daemon(self, cmd, socket_path):
+        daemon_cmd = u'%s daemon %s --idle-timeout %d' % (cmd,
+                quote(socket_path), DAEMON_IDLE_TIMEOUT)
+        logger.info(u'starting daemon "%s"' % daemon_cmd)
+        devnull = open(os.devnull, 'wb')
+        try:
+            Popen(daemon_cmd, env=self.get_subprocess_env(None), shell=True,
+                    stdout=devnull, stderr=devnull, close_fds=True)
+        finally:
+            devnull.close()
+
     # Runs the specified external command with the specific environment
     # variables that are added to the ones of the current process.
     def run_external_command(self, cmd, env):
-        # prepare the environment for a subprocess
-        penv = os.environ.copy()
-        if env is not None:
-            for k, v in env.iteritems():
-                penv[k] = v.encode('utf-8')
-        # OS X specific: when gPodder is started from a bundle (.app file)
-        # the bootstrap script sets PYTHON, PYTHONPATH, and PYTHONHOME
-        # env vars to point to the bundled python 2. Thus, an attempt to
-        # launch a python 3 script fails:
-        # "Fatal Python error: Py_Initialize: unable to load the file system codec"
-        # Here we remove all these variables before starting a subprocess.
-        penv = dict((k, v) for k, v in penv.iteritems()
-                if not k.startswith("PYTHON"))
+        penv = self.get_subprocess_env(env)
 
         logger.info(u'starting subprocess "%s"' % (cmd))
         proc = Popen(cmd, env=penv, shell=True, stdout=PIPE, stderr=PIPE)
@@ -87,6 +337,50 @@ class gPodderExtension:
             logger.error(u'subprocess "%s", returncode = %d\nstderr = "%s"' %
                     (cmd, proc.returncode, stderrdata))
 
+    # Runs the batch mode of the fixtags command with the episode infos as
+    # the manifest on its stdin.
+    def run_batch_command(self, cmd, infos):
+        batch_cmd = u'%s batch' % cmd
+        manifest = b''.join((json.dumps(info) + '\n').encode('utf-8')
+                for info in infos)
+
+        logger.info(u'starting subprocess "%s" for %d episodes' %
+                (batch_cmd, len(infos)))
+        proc = Popen(batch_cmd, env=self.get_subprocess_env(None), shell=True,
+                stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        (stdoutdata, stderrdata) = proc.communicate(manifest)
+
+        for line in stdoutdata.decode('utf-8').splitlines():
+            try:
+                result = json.loads(line)
+            except ValueError:
+                logger.info(u'stdout = "%s"' % line)
+                continue
+            self.log_result(u'fixtags batch', result.get('filename'), result)
+        if proc.returncode != 0:
+            logger.error(u'subprocess "%s", returncode = %d\nstderr = "%s"' %
+                    (batch_cmd, proc.returncode, stderrdata))
+
+    # Returns the environment for a subprocess: the one of the current
+    # process with the specific variables added.
+    def get_subprocess_env(self, env):
+        # prepare the environment for a subprocess
+        penv = os.environ.copy()
+        if env is not None:
+            for k, v in env.items():
+                # python 2 needs the unicode values encoded
+                if not isinstance(v, str):
+                    v = v.encode('utf-8')
+                penv[k] = v
+        # OS X specific: when gPodder is started from a bundle (.app file)
+        # the bootstrap script sets PYTHON, PYTHONPATH, and PYTHONHOME
+        # env vars to point to the bundled python 2. Thus, an attempt to
+        # launch a python 3 script fails:
+        # "Fatal Python error: Py_Initialize: unable to load the file system codec"
+        # Here we remove all these variables before starting a subprocess.
+        return dict((k, v) for k, v in penv.items()
+                if not k.startswith("PYTHON"))
+
     # Gets necessary info from the episode object into a dictionary with
     # the keys specified earlier. The keys actually correspond to the values
     # gPodder 2 used when calling an external post-download script.
@@ -98,8 +392,11 @@ class gPodderExtension:
                 Key.EPISODE_PUBDATE: None
         }
 
-        info[Key.FILENAME] = episode.local_filename(create=False,
-                check_only=True).decode('utf-8')
+        filename = episode.local_filename(create=False, check_only=True)
+        # the filename is bytes in python 2 and str in python 3
+        if isinstance(filename, bytes):
+            filename = filename.decode('utf-8')
+        info[Key.FILENAME] = filename
         info[Key.EPISODE_TITLE] = episode.trimmed_title
         info[Key.CHANNEL_TITLE] = episode.channel.title
         info[Key.EPISODE_PUBDATE] = str(episode.published)
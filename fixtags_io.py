@@ -0,0 +1,468 @@
+# Author: pluton <pluton.od (at) gmail.com>
+# License: GPL v3
+
+'''Reading and writing the tags of the episode files for fixtags.py.
+
+stagger is used to encode and decode the tags, but the files are accessed
+here so that every episode is opened and rewritten as little as possible.
+'''
+
+import os
+import errno
+
+# size of the ID3v1 tag at the end of a file
+ID3V1_SIZE = 128
+# size of the ID3v2 header (and footer)
+ID3V2_HEADER_SIZE = 10
+# the flag of the ID3v2.4 footer presence
+ID3V24_FOOTER = 0x10
+
+# the flags of the ID3v2 header that make the frames unreadable one by one:
+# unsynchronisation, and the extended header (compression in ID3v2.2)
+ID3V2_UNSYNC = 0x80
+ID3V2_EXTENDED = 0x40
+# the sizes of the frame headers by the ID3v2 version
+FRAME_HEADER_SIZES = {2: 6, 3: 10, 4: 10}
+
+# size of the buffer for moving the audio data within a file
+BUFFER_SIZE = 1 << 20
+
+# The ways to copy the audio data, the fastest first: 'copy_file_range' and
+# 'sendfile' copy it in the kernel, 'buffer' reads and writes it here. The
+# ones that fail with COPY_ERRNOS are not tried again for the same devices.
+COPY_METHODS = ['copy_file_range', 'sendfile', 'buffer']
+# the errors of a copy method that isn't supported for the files
+COPY_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSOCK,
+        errno.EOPNOTSUPP, errno.ENOTSUP)
+# the sets of the copy methods that failed by the (source, destination)
+# devices of the files, as a filesystem may not support them while others do
+COPY_FAILURES = {}
+# the smallest chunk worth copying in the kernel; the audio data that moves by
+# less within a file is moved through the buffer
+MIN_KERNEL_CHUNK = 64 * 1024
+
+# How many bytes of padding to reserve when a tag doesn't fit into the space
+# of the old one, so that the later fixes can update it in place.
+PADDING = 4096
+
+# Whether the file is written to a temporary file next to it and renamed over
+# it when the audio data has to be moved, so that a crash leaves either the
+# old or the new file instead of a half-moved one.
+ATOMIC = False
+
+# Whether the directory is synced after every atomic write. The batches turn
+# it off and call sync_directories() once for all the files.
+SYNC_DIRECTORY = True
+
+
+def syncsafe_decode(data):
+    '''Returns the integer encoded in the syncsafe bytes.'''
+
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7f)
+    return value
+
+def syncsafe_encode(value):
+    '''Returns the 4 syncsafe bytes encoding the integer.'''
+
+    return bytes(((value >> shift) & 0x7f) for shift in (21, 14, 7, 0))
+
+def id3v2_length(header):
+    '''Returns the full length of the ID3v2 tag (header and footer included)
+    that starts with the header bytes, or 0 if there is no tag.'''
+
+    if len(header) < ID3V2_HEADER_SIZE or header[0:3] != b'ID3':
+        return 0
+    if header[3] not in (2, 3, 4):
+        raise ValueError('Unknown ID3 version: 2.{0}.{1}'.format(
+            header[3], header[4]))
+    length = syncsafe_decode(header[6:10]) + ID3V2_HEADER_SIZE
+    if header[3] == 4 and header[5] & ID3V24_FOOTER:
+        length += ID3V2_HEADER_SIZE
+    return length
+
+def frame_header(version, header):
+    '''Returns the (frame id, body size) pair of the frame header of the
+    ID3v2 version, or None if it's padding.
+
+    Raises ValueError if the frame id isn't valid or the size of a v2.4
+    frame isn't syncsafe (old iTunes writes 8-bit sizes), as stagger
+    handles these cases by looking at the whole tag.'''
+
+    if header[0] == 0:
+        return None
+    id_size = 3 if version == 2 else 4
+    if not all(0x30 <= byte <= 0x39 or 0x41 <= byte <= 0x5a
+            for byte in header[0:id_size]):
+        raise ValueError('Invalid frame id: {0!r}'.format(
+            header[0:id_size]))
+    if version == 2:
+        size = int.from_bytes(header[3:6], 'big')
+    elif version == 3:
+        size = int.from_bytes(header[4:8], 'big')
+    else:
+        if any(byte & 0x80 for byte in header[4:8]):
+            raise ValueError('Frame size is not syncsafe')
+        size = syncsafe_decode(header[4:8])
+    return (header[0:id_size].decode('latin-1'), size)
+
+def read_frames(file, header, length, skip_frames):
+    '''Reads the frames of the ID3v2 tag, which has the header and the full
+    length, from the file positioned after the header. The bodies of the
+    `skip_frames` are seeked over rather than read.
+
+    Returns the tuple of the tag bytes without the skipped frames, the list
+    of the (frame id, body size) pairs of the skipped ones and the number
+    of bytes read, or None if the frames can't be told apart without
+    reading the whole tag.'''
+
+    version = header[3]
+    if header[5] & (ID3V2_UNSYNC | ID3V2_EXTENDED):
+        return None
+    header_size = FRAME_HEADER_SIZES[version]
+    end = length
+    if version == 4 and header[5] & ID3V24_FOOTER:
+        end -= ID3V2_HEADER_SIZE
+
+    frames = []
+    skipped = []
+    bytes_read = 0
+    pos = ID3V2_HEADER_SIZE
+    while pos + header_size <= end:
+        frame = file.read(header_size)
+        bytes_read += len(frame)
+        if len(frame) < header_size:
+            return None
+        try:
+            info = frame_header(version, frame)
+        except ValueError:
+            return None
+        if info is None:
+            # the rest is padding
+            break
+        (frameid, size) = info
+        pos += header_size + size
+        if pos > end:
+            return None
+        if frameid in skip_frames:
+            file.seek(size, os.SEEK_CUR)
+            skipped.append((frameid, size))
+            continue
+        body = file.read(size)
+        bytes_read += len(body)
+        if len(body) < size:
+            return None
+        frames.append(frame + body)
+
+    data = b''.join(frames)
+    # the footer isn't kept
+    return (header[0:5] + bytes([header[5] & ~ID3V24_FOOTER]) +
+            syncsafe_encode(len(data)) + data, skipped, bytes_read)
+
+def read_tag_data(filename, skip_frames=()):
+    '''Reads the tags of the file without touching the audio data: the ID3v2
+    header, the tag of the size it declares, and the last ID3v1_SIZE bytes.
+
+    The frames with the ids in `skip_frames` (e.g. the artwork that is going
+    to be deleted) are left out of the tag: only their headers are read, so
+    the memory used doesn't depend on their size.
+
+    Returns the tuple of the ID3v2 tag bytes for `stagger.decode_tag()` (just
+    the header if there is no valid tag), whether the file ends with an ID3v1
+    tag, the number of bytes read, the file size and the list of the
+    (frame id, body size) pairs of the skipped frames.
+    '''
+
+    # unbuffered, so that nothing is read ahead into the audio data
+    with open(filename, 'rb', buffering=0) as file:
+        data = file.read(ID3V2_HEADER_SIZE)
+        try:
+            length = id3v2_length(data)
+        except ValueError:
+            # let stagger complain about the header
+            length = 0
+        bytes_read = len(data)
+        skipped = []
+        frames = None
+        if skip_frames and length > 0:
+            frames = read_frames(file, data, length, skip_frames)
+            if frames is None:
+                file.seek(ID3V2_HEADER_SIZE)
+            else:
+                (data, skipped, frames_read) = frames
+                bytes_read += frames_read
+        if frames is None:
+            while len(data) < length:
+                chunk = file.read(length - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            bytes_read = len(data)
+
+        has_v1 = False
+        file_size = file.seek(0, os.SEEK_END)
+        if file_size - length >= ID3V1_SIZE:
+            file.seek(-ID3V1_SIZE, os.SEEK_END)
+            has_v1 = file.read(3) == b'TAG'
+            bytes_read += 3
+    return (data, has_v1, bytes_read, file_size, skipped)
+
+class TagSummary:
+    '''The fields of a tag worth reporting, without its frames, so that the
+    results of a whole library take little memory whatever the artwork.'''
+
+    __slots__ = ('version', 'title', 'artist', 'album', 'date', 'genre',
+            'track', 'has_v1', 'has_apic')
+
+    def __init__(self, tag2, has_v1):
+        self.version = tag2.version
+        self.title = tag2.title
+        self.artist = tag2.artist
+        self.album = tag2.album
+        self.date = tag2.date
+        self.genre = tag2.genre
+        self.track = tag2.track
+        self.has_v1 = has_v1
+        self.has_apic = any(frame.frameid in ('APIC', 'PIC')
+                for frame in tag2.frames())
+
+    def as_dict(self):
+        '''Returns the fields as a dictionary that can be dumped to JSON.'''
+
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+def frame_key(frame):
+    '''Returns the comparable contents of the frame: its id and fields,
+    except the text encoding, which stagger picks when writing.'''
+
+    return (frame.frameid, tuple((spec.name, getattr(frame, spec.name, None))
+        for spec in frame._framespec if spec.name != 'encoding'))
+
+def frames_snapshot(tag2, skipped=()):
+    '''Returns the comparable contents of the tag, or None if there is
+    no tag. The snapshot doesn't change when the tag is modified later.
+
+    The (frame id, body size) pairs of the frames skipped by
+    `read_tag_data` are added as frames with the 'size' field.'''
+
+    if tag2 is None:
+        return None
+    return (tag2.version, [frame_key(frame) for frame in tag2.frames()] +
+            [(frameid, (('size', size),)) for (frameid, size) in skipped])
+
+def json_value(value):
+    '''Returns the frame field value that can be dumped to JSON; binary
+    data is replaced with its size.'''
+
+    if isinstance(value, bytes):
+        return '<{0} bytes>'.format(len(value))
+    if isinstance(value, (list, tuple)):
+        return [json_value(item) for item in value]
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+def frames_diff(before, after):
+    '''Returns the difference between the snapshots of the tags that can be
+    dumped to JSON: the dictionary that maps the ids of the changed frames
+    to the 'old' and 'new' lists of their fields, and 'version' to the old
+    and new versions if the version changes.'''
+
+    (old_version, old_frames) = before if before is not None else (None, [])
+    (new_version, new_frames) = after
+    diff = {}
+    if old_version != new_version:
+        diff['version'] = [old_version, new_version]
+    frameids = []
+    for (frameid, fields) in old_frames + new_frames:
+        if frameid not in frameids:
+            frameids.append(frameid)
+    for frameid in frameids:
+        old = [fields for (key, fields) in old_frames if key == frameid]
+        new = [fields for (key, fields) in new_frames if key == frameid]
+        if old != new:
+            diff[frameid] = {
+                'old': [dict((name, json_value(value))
+                    for (name, value) in fields) for fields in old],
+                'new': [dict((name, json_value(value))
+                    for (name, value) in fields) for fields in new],
+            }
+    return diff
+
+def pad_tag(data, size):
+    '''Returns the encoded ID3v2 tag padded with zeros to the size.'''
+
+    return (data[:6] + syncsafe_encode(size - ID3V2_HEADER_SIZE) +
+            data[ID3V2_HEADER_SIZE:] + bytes(size - len(data)))
+
+def copy_once(method, src_fd, src, dst_fd, dst, size):
+    '''Copies at most `size` bytes from the `src` offset of the `src_fd`
+    file to the `dst` offset of the `dst_fd` one with the method. Returns the
+    number of bytes copied.'''
+
+    if method == 'copy_file_range':
+        return os.copy_file_range(src_fd, dst_fd, size, src, dst)
+    if method == 'sendfile':
+        os.lseek(dst_fd, dst, os.SEEK_SET)
+        return os.sendfile(dst_fd, src_fd, src, size)
+    return os.pwrite(dst_fd, os.pread(src_fd, size, src), dst)
+
+def copy_chunk(src_fd, src, dst_fd, dst, size, kernel=True):
+    '''Copies `size` bytes between the files like `copy_once` with the
+    first method in COPY_METHODS that works for their devices (see
+    COPY_FAILURES), or through the buffer if not `kernel`. Returns the
+    method.'''
+
+    failed = ()
+    if kernel:
+        devices = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+        failed = COPY_FAILURES.get(devices, ())
+    while size > 0:
+        for method in COPY_METHODS:
+            if method == 'buffer' or (kernel and hasattr(os, method) and
+                    method not in failed):
+                break
+        try:
+            copied = copy_once(method, src_fd, src, dst_fd, dst, size)
+        except OSError as e:
+            if method == 'buffer' or e.errno not in COPY_ERRNOS:
+                raise
+            failed = COPY_FAILURES.setdefault(devices, set())
+            failed.add(method)
+            continue
+        if copied == 0:
+            raise EOFError('The file is shorter than expected')
+        src += copied
+        dst += copied
+        size -= copied
+    return method
+
+def move_data(file, src, dst, length):
+    '''Moves `length` bytes of the file from the `src` offset to `dst`.
+    The regions may overlap. Returns the copy method (see COPY_METHODS), or
+    None if nothing is moved.'''
+
+    fd = file.fileno()
+    # the kernel copies chunks that don't overlap, the buffer is read whole
+    # before it's written
+    chunk = min(BUFFER_SIZE, abs(dst - src))
+    kernel = chunk >= MIN_KERNEL_CHUNK
+    if not kernel:
+        chunk = BUFFER_SIZE
+    method = None
+    if dst > src:
+        # go from the end so that the data isn't overwritten before it's moved
+        pos = length
+        while pos > 0:
+            size = min(chunk, pos)
+            pos -= size
+            method = copy_chunk(fd, src + pos, fd, dst + pos, size, kernel)
+    elif dst < src:
+        pos = 0
+        while pos < length:
+            size = min(chunk, length - pos)
+            method = copy_chunk(fd, src + pos, fd, dst + pos, size, kernel)
+            pos += size
+    return method
+
+def sync_directory(directory):
+    '''Flushes the entries of the directory (e.g. a rename) to the disk.'''
+
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_directories(filenames):
+    '''Syncs the directories of the files once each.'''
+
+    for directory in set(os.path.dirname(os.path.realpath(filename))
+            for filename in filenames):
+        sync_directory(directory)
+
+def write_atomically(file, filename, data, audio_start, audio_length):
+    '''Writes the tag data and the audio data of the open file to
+    a temporary file in the same directory, syncs it and renames it over the
+    file. Returns the copy method of the audio data (see COPY_METHODS).'''
+
+    import tempfile
+    filename = os.path.realpath(filename)
+    directory = os.path.dirname(filename)
+    (fd, temp_filename) = tempfile.mkstemp(dir=directory,
+            prefix='.' + os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with open(fd, 'wb') as temp:
+            temp.write(data)
+            temp.flush()
+            method = None
+            pos = 0
+            while pos < audio_length:
+                size = min(BUFFER_SIZE, audio_length - pos)
+                method = copy_chunk(file.fileno(), audio_start + pos,
+                        temp.fileno(), len(data) + pos, size)
+                pos += size
+            os.chmod(temp_filename, os.fstat(file.fileno()).st_mode & 0o7777)
+            os.fsync(temp.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+    if SYNC_DIRECTORY:
+        sync_directory(directory)
+    return method
+
+def write_tags(filename, tag2, delete_v1=False):
+    '''Writes the ID3v2 tag to the start of the file, replacing the existing
+    one, and removes the ID3v1 tag if `delete_v1`.
+
+    It's the same as `Tag1.delete()` followed by `tag2.write()` in stagger,
+    but the file is opened once and the audio data is moved at most once.
+    If the new tag fits into the space of the old one, the rest of it
+    becomes padding and the audio data isn't touched; otherwise `PADDING`
+    bytes are reserved after the new tag, and with ATOMIC the file is
+    rewritten by `write_atomically()` instead of being moved in place.
+
+    Returns the pair of the number of bytes written and the copy method of
+    the audio data (see COPY_METHODS), which is None if it isn't moved.
+    '''
+
+    # unbuffered, as the audio data is copied by the file descriptor
+    with open(filename, 'rb+', buffering=0) as file:
+        old_length = id3v2_length(file.read(ID3V2_HEADER_SIZE))
+        file_size = file.seek(0, os.SEEK_END)
+
+        # the audio data is between the tags
+        audio_end = file_size
+        if delete_v1 and file_size - old_length >= ID3V1_SIZE:
+            file.seek(-ID3V1_SIZE, os.SEEK_END)
+            if file.read(3) == b'TAG':
+                audio_end -= ID3V1_SIZE
+
+        # stagger can't read a tag back if its padding is shorter than
+        # a frame header: the first frame is the only one it finds
+        tag2.padding_default = 0
+        data = tag2.encode()
+        if (len(data) == old_length or
+                len(data) + ID3V2_HEADER_SIZE <= old_length):
+            data = pad_tag(data, old_length)
+        elif PADDING > 0:
+            data = pad_tag(data,
+                    len(data) + max(PADDING, ID3V2_HEADER_SIZE))
+
+        audio_length = audio_end - old_length
+        written = len(data)
+        method = None
+        if len(data) != old_length and ATOMIC:
+            method = write_atomically(file, filename, data, old_length,
+                    audio_length)
+            return (written + audio_length, method)
+        if len(data) != old_length:
+            method = move_data(file, old_length, len(data), audio_length)
+            written += audio_length
+        file.seek(0)
+        file.write(data)
+        if len(data) + audio_length < file_size:
+            file.truncate(len(data) + audio_length)
+    return (written, method)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Author: pluton <pluton.od (at) gmail.com>
+# License: GPL v3
+
+'''Tests of fixtags_ext.py in a python 3 gPodder.
+
+gPodder itself isn't needed: the extension gets a stand-in for the
+`gpodder` module and for the episodes it's called with.
+'''
+
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+
+# the extension only imports the gpodder module
+sys.modules.setdefault('gpodder', types.ModuleType('gpodder'))
+import fixtags_ext
+
+from test_fixtags_io import frame, id3v2_tag
+
+try:
+    import stagger
+except Exception:
+    stagger = None
+
+class Episode:
+    '''The downloaded episode like gPodder 3 passes to the extension.'''
+
+    def __init__(self, filename, title, channel_title, published):
+        self.filename = filename
+        self.trimmed_title = title
+        self.channel = types.SimpleNamespace(title=channel_title)
+        self.published = published
+
+    def local_filename(self, create, check_only=False):
+        return self.filename
+
+class ExtensionTest(unittest.TestCase):
+    '''Fixes the downloaded episodes with the extension.'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'episode.mp3')
+        with open(self.filename, 'wb') as file:
+            file.write(id3v2_tag([frame('TIT2', b'\0Episode 1'),
+                frame('TPE1', b'\0Stacktrace')], padding=1024))
+            file.write(bytes(64 * 1024))
+        self.config = types.SimpleNamespace(_name='extensions.fixtags_ext',
+                fixtags_cmd=os.path.abspath(fixtags_ext.__file__).replace(
+                    'fixtags_ext.py', 'fixtags.py'),
+                fixtags_socket='', fixtags_batch_window=0,
+                fixtags_batch_size=20)
+        self.extension = fixtags_ext.gPodderExtension(
+                types.SimpleNamespace(config=self.config))
+        self.episode = Episode(self.filename, 'Episode 1', 'Stacktrace',
+                1370000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_episode_info(self):
+        info = self.extension.get_episode_info(self.episode)
+        self.assertEqual(info[fixtags_ext.Key.FILENAME], self.filename)
+        self.assertEqual(info[fixtags_ext.Key.EPISODE_PUBDATE], '1370000000')
+        env = self.extension.get_subprocess_env(info)
+        self.assertEqual(env[fixtags_ext.Key.CHANNEL_TITLE], 'Stacktrace')
+        self.assertFalse([k for k in env if k.startswith('PYTHON')])
+
+    @unittest.skipIf(stagger is None, 'stagger is not available')
+    def test_fix_in_process(self):
+        results = []
+        fix_in_process = self.extension.fix_in_process
+        def record(engine, infos):
+            fix_in_process(engine, infos)
+            results.extend(infos)
+        self.extension.fix_in_process = record
+        self.extension.on_episode_downloaded(self.episode)
+        self.extension.on_unload()
+
+        self.assertEqual([info[fixtags_ext.Key.FILENAME] for info in results],
+                [self.filename])
+        tag = stagger.read_tag(self.filename)
+        self.assertEqual(tag.title, 'Episode 1')
+        self.assertEqual(tag.genre, 'Podcast')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Author: pluton <pluton.od (at) gmail.com>
+# License: GPL v3
+
+'''Tests of fixtags_io.py.
+
+The episode files are sparse, so that a 1 GiB file takes no space and any
+read of its audio data shows up in the number of bytes read. The bytes are
+counted by the kernel, in /proc/self/io, rather than by the code under test.
+'''
+
+import os
+import errno
+import shutil
+import struct
+import tempfile
+import unittest
+
+import fixtags_io
+
+try:
+    import stagger
+    import fixtags
+except Exception:
+    stagger = None
+
+# size of the sparse episode files
+FILE_SIZE = 1 << 30
+# the most bytes reading the tags of an episode may take
+MAX_BYTES_READ = 16 * 1024
+# the bytes `fixtags_io.write_tags` reads that aren't counted in the results:
+# the old ID3v2 header and the ID3v1 marker
+WRITE_BYTES_READ = fixtags_io.ID3V2_HEADER_SIZE + 3
+# the I/O counters of this process
+PROC_IO_FILENAME = '/proc/self/io'
+
+def process_bytes_read():
+    '''Returns the bytes read by the read system calls of this process.'''
+
+    with open(PROC_IO_FILENAME) as file:
+        for line in file:
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+
+def measure_reads(function, *args):
+    '''Calls the function with the args. Returns the tuple of its result
+    and the bytes it read, without the reads of PROC_IO_FILENAME.'''
+
+    start = process_bytes_read()
+    overhead = process_bytes_read() - start
+    start = process_bytes_read()
+    result = function(*args)
+    return (result, process_bytes_read() - start - overhead)
+
+def frame(frame_id, body):
+    '''Returns the ID3v2.3 frame with the id and the body.'''
+
+    return frame_id.encode('latin-1') + struct.pack('>IH', len(body), 0) + body
+
+def id3v2_tag(frames, padding=0):
+    '''Returns the ID3v2.3 tag with the frames and the padding.'''
+
+    data = b''.join(frames) + bytes(padding)
+    return b'ID3\x03\x00\x00' + fixtags_io.syncsafe_encode(len(data)) + data
+
+def id3v1_tag(title):
+    '''Returns the ID3v1 tag with the title.'''
+
+    return (b'TAG' + title.encode('latin-1').ljust(30, b'\0')).ljust(
+            fixtags_io.ID3V1_SIZE, b'\0')
+
+@unittest.skipUnless(os.path.exists(PROC_IO_FILENAME),
+        'the bytes read are counted by /proc')
+class EpisodeTest(unittest.TestCase):
+    '''Reads the tags of sparse 1 GiB episodes.'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'episode.mp3')
+        self.tag = id3v2_tag([frame('TIT2', b'\0Episode 1'),
+            frame('TPE1', b'\0Stacktrace'),
+            frame('APIC', b'\0image/png\0\x03\0' + bytes(100 * 1024))],
+            padding=2048)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_episode(self, tag2, tag1):
+        '''Writes the sparse episode file of FILE_SIZE bytes with the tags.'''
+
+        with open(self.filename, 'wb') as file:
+            file.write(tag2)
+            file.truncate(FILE_SIZE)
+            if tag1:
+                file.seek(FILE_SIZE - fixtags_io.ID3V1_SIZE)
+                file.write(tag1)
+
+    def assertRead(self, bytes_read, counted, limit=MAX_BYTES_READ,
+            uncounted=0):
+        '''Checks that the bytes read from the episode are below the limit
+        and that the counted ones are all of them but the `uncounted`.'''
+
+        self.assertLess(bytes_read, limit)
+        self.assertGreaterEqual(bytes_read, counted)
+        self.assertLessEqual(bytes_read, counted + uncounted)
+
+class ReadTagDataTest(EpisodeTest):
+    '''Reads the tags of sparse 1 GiB episodes with `read_tag_data`.'''
+
+    def test_both_tags(self):
+        self.write_episode(self.tag, id3v1_tag('Episode 1'))
+        ((data, has_v1, bytes_read, file_size, skipped), really_read) = \
+                measure_reads(fixtags_io.read_tag_data, self.filename,
+                        ('APIC',))
+        self.assertTrue(data.startswith(b'ID3\x03'))
+        self.assertIn(b'Episode 1', data)
+        self.assertNotIn(b'image/png', data)
+        self.assertTrue(has_v1)
+        self.assertEqual(file_size, FILE_SIZE)
+        self.assertEqual([frame_id for (frame_id, size) in skipped], ['APIC'])
+        self.assertRead(really_read, bytes_read)
+
+    def test_whole_tag(self):
+        self.write_episode(self.tag, id3v1_tag('Episode 1'))
+        ((data, has_v1, bytes_read, file_size, skipped), really_read) = \
+                measure_reads(fixtags_io.read_tag_data, self.filename)
+        self.assertEqual(data, self.tag)
+        self.assertTrue(has_v1)
+        self.assertEqual(skipped, [])
+        # the tag itself, but none of the audio data
+        self.assertRead(really_read, bytes_read,
+                len(self.tag) + MAX_BYTES_READ)
+
+    def test_no_tags(self):
+        self.write_episode(b'', None)
+        ((data, has_v1, bytes_read, file_size, skipped), really_read) = \
+                measure_reads(fixtags_io.read_tag_data, self.filename)
+        self.assertFalse(has_v1)
+        self.assertEqual(file_size, FILE_SIZE)
+        self.assertRead(really_read, bytes_read)
+
+@unittest.skipUnless(hasattr(os, 'copy_file_range') and
+        hasattr(os, 'sendfile'), 'the kernel copy methods are not available')
+class CopyChunkTest(unittest.TestCase):
+    '''Copies the audio data with the methods that fail.'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'episode.mp3')
+        with open(self.filename, 'wb') as file:
+            file.write(bytes(range(256)) * 1024)
+        self.copy_once = fixtags_io.copy_once
+        self.failures = dict(fixtags_io.COPY_FAILURES)
+        fixtags_io.COPY_FAILURES.clear()
+
+    def tearDown(self):
+        fixtags_io.copy_once = self.copy_once
+        fixtags_io.COPY_FAILURES.clear()
+        fixtags_io.COPY_FAILURES.update(self.failures)
+        shutil.rmtree(self.directory)
+
+    def copy_chunk(self, failing):
+        '''Copies the start of the episode to its end while the `failing`
+        method fails with EINVAL. Returns the method that copied it.'''
+
+        def copy_once(method, *args):
+            if method == failing:
+                raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+            return self.copy_once(method, *args)
+        fixtags_io.copy_once = copy_once
+        with open(self.filename, 'rb+', buffering=0) as file:
+            method = fixtags_io.copy_chunk(file.fileno(), 0, file.fileno(),
+                    128 * 1024, 128 * 1024)
+        with open(self.filename, 'rb') as file:
+            data = file.read()
+        self.assertEqual(data[128 * 1024:], data[:128 * 1024])
+        return method
+
+    def test_failure_per_device(self):
+        self.assertEqual(self.copy_chunk('copy_file_range'), 'sendfile')
+        device = os.stat(self.filename).st_dev
+        self.assertEqual(fixtags_io.COPY_FAILURES,
+                {(device, device): {'copy_file_range'}})
+        # the method is still tried for the other devices
+        self.assertIn('copy_file_range', fixtags_io.COPY_METHODS)
+        self.assertEqual(self.copy_chunk(None), 'sendfile')
+
+@unittest.skipIf(stagger is None, 'stagger is not available')
+class ApplyRuleTest(EpisodeTest):
+    '''Fixes sparse 1 GiB episodes with the rules of fixtags.py.'''
+
+    def apply_rule(self, channel_title):
+        '''Fixes the episode with the rule of the channel. Returns the
+        result of `fixtags.apply_rule` and the bytes it read.'''
+
+        rule = fixtags.find_rule(channel_title)
+        return measure_reads(fixtags.apply_rule, rule, self.filename,
+                {'episode_title': 'Episode 1',
+                    'channel_title': channel_title, 'episode_year': '2013'})
+
+    def test_read_rule(self):
+        self.write_episode(self.tag, id3v1_tag('Episode 1'))
+        (result, really_read) = self.apply_rule('Stacktrace')
+        self.assertEqual(result['outcome'], 'fixed')
+        self.assertEqual(result['file_size'], FILE_SIZE)
+        # the rule keeps the artwork, so the whole tag is read
+        self.assertRead(really_read, result['bytes_read'],
+                len(self.tag) + MAX_BYTES_READ, WRITE_BYTES_READ)
+        # the tag fits into its space, so only the tag is written
+        self.assertEqual(os.path.getsize(self.filename), FILE_SIZE)
+        self.assertIsNone(result['copy_method'])
+        self.assertLessEqual(result['bytes_written'], len(self.tag))
+        tag = stagger.read_tag(self.filename)
+        self.assertEqual(tag.genre, 'Podcast')
+        self.assertEqual(tag.title, 'Episode 1')
+
+    def test_new_rule(self):
+        self.write_episode(self.tag, id3v1_tag('Episode 1'))
+        (result, really_read) = self.apply_rule('EconTalk')
+        self.assertEqual(result['outcome'], 'fixed')
+        # the old artwork is skipped
+        self.assertRead(really_read, result['bytes_read'],
+                uncounted=WRITE_BYTES_READ)
+        self.assertEqual(os.path.getsize(self.filename), FILE_SIZE -
+                (fixtags_io.ID3V1_SIZE if result['delete_v1'] else 0))
+        self.assertEqual(stagger.read_tag(self.filename).version, 4)
+
+if __name__ == '__main__':
+    unittest.main()